@@ -1,22 +1,27 @@
 import base64
-import binascii
-import hashlib
+import email.utils
 import json
 import os
 import pathlib
+import threading
 import time
 
-import Crypto.PublicKey.RSA
 import OpenSSL
+import requests
 
-
-from urllib.request import urlopen, Request  # Python 3
+from . import keys
+from .AcmeSession import AcmeSession
 
 
 __version__ = "0.2.0"
 
 
 class Acme(object):
+    # directory documents of the acme servers: api_url -> (directory, time fetched)
+    _directories = {}
+    _directories_lock = threading.Lock()
+    directory_ttl = 3600
+
     def __init__(
             self,
             nginx,
@@ -31,6 +36,9 @@ class Acme(object):
             skip_nginx_reload=False,
             debug=False,
             challenge_dir="/tmp/acme-challenges",
+            http=None,
+            account_key_type="rsa2048",
+            domain_key_type="rsa2048",
     ):
         """
         Params:
@@ -44,6 +52,9 @@ class Acme(object):
             cert_path, str, path to output certificate file
             dns_provider, list, dns provider that is used for dns challenge
             skip_nginx_reload, bool, should nginx be reloaded after certificate issue
+            http, requests.Session, keep-alive session to the acme server, shared between clients if provided
+            account_key_type, str, type of the account key if it's created, e.g. rsa2048 or p256
+            domain_key_type, str, type of the certificate private key if it's created, e.g. rsa2048 or p256
         """
         self.nginx=nginx
         self.debug = debug
@@ -53,6 +64,8 @@ class Acme(object):
         self.vhost = vhost
         self.account_key = account_key
         self.domain_key = domain_key
+        self.account_key_type = account_key_type
+        self.domain_key_type = domain_key_type
         self.cert_path = cert_path
         self.api_url = api_url
         self.log = logger
@@ -60,11 +73,28 @@ class Acme(object):
         self.chain = "https://letsencrypt.org/certs/lets-encrypt-x3-cross-signed.pem"
         self.dns_provider = dns_provider
         self.skip_nginx_reload = skip_nginx_reload
+        # parsed account key and nonces, shared with the other clients of the same account
+        self.session = AcmeSession.for_account(account_key)
+        self.http = http if http is not None else requests.Session()
         path = pathlib.Path(challenge_dir)
         self.challenge_dir = path
         if not path.exists():
             path.mkdir(parents=True)
 
+    def get_directory(self):
+        """
+        Return a copy of the directory document of the acme server.
+        The document is fetched once and reused by all the clients for `directory_ttl` seconds.
+        """
+        with Acme._directories_lock:
+            cached = Acme._directories.get(self.api_url)
+            if cached is None or time.monotonic() - cached[1] > self.directory_ttl:
+                response = self.http.get(self.api_url, headers={"Content-Type": "application/jose+json"})
+                response.raise_for_status()
+                cached = (response.json(), time.monotonic())
+                Acme._directories[self.api_url] = cached
+            return dict(cached[0])
+
     def _reload_nginx(self):
         """ signal nginx master process to reload configuration """
         self.nginx.reload()
@@ -74,13 +104,12 @@ class Acme(object):
         with open(os.path.join(self.challenge_dir, token), 'w') as fd:
             fd.write("{0}.{1}".format(token, thumbprint))
 
-    def create_key(self, key_path, key_type=OpenSSL.crypto.TYPE_RSA, bits=2048):
+    def create_key(self, key_path, key_type="rsa2048"):
         """
         Return created private key and writes it into key_path
         Params:
             key_path, str, writable path for key
-            key_type, int, SSL key type
-            bits, int, the number of bits of the key
+            key_type, str, key type e.g. rsa2048, rsa4096, p256 or p384
         Return:
             string with private key
         """
@@ -88,8 +117,7 @@ class Acme(object):
             with open(key_path, 'r') as fd:
                 private_key = fd.read()
         except IOError:
-            key = OpenSSL.crypto.PKey()
-            key.generate_key(key_type, bits)
+            key = keys.generate_key(key_type)
             private_key = OpenSSL.crypto.dump_privatekey(
                 OpenSSL.crypto.FILETYPE_PEM, key)
             self.log.info('can not open key, writing new in {path}'.format(path=key_path))
@@ -98,6 +126,8 @@ class Acme(object):
             with open(key_path, 'wb') as fd:
                 fd.write(private_key)
             os.chmod(key_path, 0o400)
+            if key_path == self.account_key:
+                self.session.invalidate_key()
         return private_key
 
     def create_csr(self):
@@ -130,38 +160,18 @@ class Acme(object):
         Return:
             string with signed message
         """
-        with open(self.account_key, 'r') as fd:
-            key = fd.read()
-        pk = OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, key)
-        return OpenSSL.crypto.sign(pk, message.encode('utf8'), "sha256")
+        return keys.sign(self.session.key(), message.encode('utf8'))
 
     def _jws(self):
         """ Return JWS dict from string account key """
-        with open(self.account_key, 'r') as fd:
-            key = fd.read()
-        pk = OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, key)
-        pk_asn1 = OpenSSL.crypto.dump_privatekey(OpenSSL.crypto.FILETYPE_ASN1, pk)
-        k = Crypto.PublicKey.RSA.importKey(pk_asn1)
-        # private key public exponent in hex format
-        exponent = "{0:x}".format(k.e)
-        exponent = "0{0}".format(exponent) if len(exponent) % 2 else exponent
-        # private key modulus in hex format
-        modulus = "{0:x}".format(k.n)
         header = {
-            "alg": "RS256",
-            "jwk": {
-                "e": self._b64(binascii.unhexlify(exponent.encode('utf8'))),
-                "kty": "RSA",
-                "n": self._b64(binascii.unhexlify(modulus.encode('utf8')))}}
+            "alg": self.session.alg(),
+            "jwk": self.session.jwk()}
         return header
 
     def _thumbprint(self):
         """ Return account thumbprint """
-        accountkey_json = json.dumps(
-            self._jws()['jwk'],
-            sort_keys=True,
-            separators=(',', ':'))
-        return self._b64(hashlib.sha256(accountkey_json.encode('utf8')).digest())
+        return self.session.thumbprint()
 
     def _cleanup(self, files):
         if not self.debug:
@@ -177,17 +187,45 @@ class Acme(object):
 
     def _send_signed_request(self, url, payload=None, directory=None):
         """
-        Send signed request to ACME CA
+        Send signed request to ACME CA, retrying when the nonce is rejected
         Params:
             url, str, url for request
             payload, any type, any payload you want to send, usually dict
             directory, dict, directory data from acme server
         """
+        for _ in range(3):
+            code, resp_data, headers = self._send_signed_request_once(url, payload, directory)
+            if not self._is_bad_nonce(code, resp_data):
+                break
+            self.log.info('nonce rejected by acme server, retrying')
+        return code, resp_data, headers
+
+    @staticmethod
+    def _is_bad_nonce(code, resp_data):
+        if code != 400:
+            return False
+        try:
+            if isinstance(resp_data, bytes):
+                resp_data = resp_data.decode('utf8')
+            return json.loads(resp_data).get('type') == "urn:ietf:params:acme:error:badNonce"
+        except (ValueError, AttributeError):
+            return False
+
+    def _nonce(self, directory, request_headers):
+        """ Return a nonce from the pool, or a new one from the acme server if the pool is empty """
+        nonce = self.session.pop_nonce()
+        if nonce is not None:
+            return nonce
+        if directory:
+            return self.http.head(directory['newNonce'], headers=request_headers).headers['Replay-Nonce']
+        return self.http.get(self.api_url + "/directory").headers['Replay-Nonce']
+
+    def _send_signed_request_once(self, url, payload=None, directory=None):
         if not payload:
             payload = {}
         request_headers = {
             "Content-Type": "application/jose+json",
-            "User-Agent": "acme-nginx/{0} urllib".format(self.version())
+            "User-Agent": "acme-nginx/{0} requests".format(self.version())
         }
         payload64 = self._b64(json.dumps(payload).encode('utf8'))
         # If not set then ACMEv1 is used
@@ -197,15 +235,12 @@ class Acme(object):
                 protected = {'kid': directory['_kid']}
             else:
                 protected = self._jws()
-            protected["nonce"] = urlopen(Request(
-                directory['newNonce'],
-                headers=request_headers)
-            ).headers['Replay-Nonce']
+            protected["nonce"] = self._nonce(directory, request_headers)
             protected["url"] = url
-            protected["alg"] = "RS256"  # set for compatibility
+            protected["alg"] = self.session.alg()
         else:
             protected = self._jws()
-            protected["nonce"] = urlopen(self.api_url + "/directory").headers['Replay-Nonce']
+            protected["nonce"] = self._nonce(directory, request_headers)
         protected64 = self._b64(json.dumps(protected).encode('utf8'))
         signature = self._sign_message("{0}.{1}".format(protected64, payload64))
         data = json.dumps({
@@ -213,19 +248,38 @@ class Acme(object):
             "payload": payload64,
             "signature": self._b64(signature)})
         try:
-            resp = urlopen(Request(url, data=data.encode('utf8'), headers=request_headers))
-            resp_data = resp.read()
+            resp = self.http.post(url, data=data.encode('utf8'), headers=request_headers)
+            self.session.add_nonce(resp.headers)
+            resp_data = resp.content
             try:
                 resp_data = resp_data.decode('utf8')
             except UnicodeDecodeError:
                 pass
-            return resp.getcode(), resp_data, resp.headers
+            return resp.status_code, resp_data, resp.headers
         except (KeyboardInterrupt, SystemExit) as e:
             raise e
         except Exception as e:
-            return getattr(e, "code", None), \
-                   getattr(e, "read", e.__str__)(), \
-                   getattr(e, "headers", None)
+            return None, str(e), None
+
+    @staticmethod
+    def _retry_after(headers, default=5):
+        """
+        Return seconds to wait before polling again, as requested by the Retry-After header
+        Params:
+            headers, response headers
+            default, int, seconds to wait when the header is absent or invalid
+        """
+        value = headers.get('Retry-After') if headers is not None else None
+        if not value:
+            return default
+        try:
+            seconds = int(value)
+        except ValueError:
+            try:
+                seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return default
+        return min(max(seconds, 1), 60)
 
     def _verify_challenge(self, url, domain):
         """ Verify challenge for domain """
@@ -236,9 +290,10 @@ class Acme(object):
             if checks_count <= 0:
                 self.log.error('reached waiting limit')
                 return False
-            challenge_status = json.loads(urlopen(url).read().decode('utf8'))
+            resp = self.http.get(url)
+            challenge_status = resp.json()
             if challenge_status['status'] == "pending":
-                time.sleep(5)
+                time.sleep(self._retry_after(resp.headers))
                 continue
             elif challenge_status['status'] == "valid":
                 self.log.info('{0} verified!'.format(domain))
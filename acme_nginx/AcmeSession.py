@@ -0,0 +1,109 @@
+import base64
+import collections
+import hashlib
+import json
+import threading
+
+import OpenSSL
+
+from . import keys
+
+
+class AcmeSession(object):
+    """
+    State shared by all the requests made with an account key:
+    the parsed account key along with its JWS algorithm, JWK and thumbprint, the account url once registered
+    and a pool of unused nonces.
+    Nonces are refilled from the Replay-Nonce header of every ACME response,
+    so that a signed request doesn't need an extra round trip to newNonce.
+    """
+    _sessions = {}
+    _sessions_lock = threading.Lock()
+
+    def __init__(self, account_key):
+        """
+        Params:
+            account_key, str, path to the account key
+        """
+        self.account_key = account_key
+        self._lock = threading.Lock()
+        self._nonces = collections.deque(maxlen=32)
+        self._key = None
+        self._alg = None
+        self._jwk = None
+        self._thumbprint = None
+        self.kid = None  # account url, known after the account is registered
+
+    @classmethod
+    def for_account(cls, account_key):
+        """ Return the session of the account key, creating it if necessary """
+        with cls._sessions_lock:
+            session = cls._sessions.get(account_key)
+            if session is None:
+                session = cls(account_key)
+                cls._sessions[account_key] = session
+            return session
+
+    @staticmethod
+    def _b64(b):
+        return base64.urlsafe_b64encode(b).decode('utf8').replace("=", "")
+
+    def _load(self):
+        with open(self.account_key, 'r') as fd:
+            key = fd.read()
+        pk = OpenSSL.crypto.load_privatekey(OpenSSL.crypto.FILETYPE_PEM, key)
+        alg, jwk = keys.jwk(pk)
+        accountkey_json = json.dumps(jwk, sort_keys=True, separators=(',', ':'))
+        self._key = pk
+        self._alg = alg
+        self._jwk = jwk
+        self._thumbprint = self._b64(hashlib.sha256(accountkey_json.encode('utf8')).digest())
+
+    def key(self):
+        """ Return the parsed account key """
+        with self._lock:
+            if self._key is None:
+                self._load()
+            return self._key
+
+    def alg(self):
+        """ Return the JWS algorithm of the account key, e.g. RS256 or ES256 """
+        with self._lock:
+            if self._alg is None:
+                self._load()
+            return self._alg
+
+    def jwk(self):
+        """ Return a copy of the JWK of the account key """
+        with self._lock:
+            if self._jwk is None:
+                self._load()
+            return dict(self._jwk)
+
+    def thumbprint(self):
+        """ Return account thumbprint """
+        with self._lock:
+            if self._thumbprint is None:
+                self._load()
+            return self._thumbprint
+
+    def invalidate_key(self):
+        """ Forget the parsed key, e.g. when the account key file is written """
+        with self._lock:
+            self._key = None
+            self._alg = None
+            self._jwk = None
+            self._thumbprint = None
+            self.kid = None
+
+    def pop_nonce(self):
+        """ Return an unused nonce or None if the pool is empty """
+        with self._lock:
+            return self._nonces.popleft() if len(self._nonces) else None
+
+    def add_nonce(self, headers):
+        """ Store the nonce of an ACME response for later use """
+        nonce = headers.get('Replay-Nonce') if headers is not None else None
+        if nonce:
+            with self._lock:
+                self._nonces.append(nonce)
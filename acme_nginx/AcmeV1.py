@@ -18,7 +18,7 @@ class AcmeV1(Acme):
         """
         try:
             self.log.info('trying to create account key {0}'.format(self.account_key))
-            account_key = self.create_key(self.account_key)
+            account_key = self.create_key(self.account_key, self.account_key_type)
         except (KeyboardInterrupt, SystemExit) as e:
             raise e
         except Exception as e:
@@ -43,7 +43,7 @@ class AcmeV1(Acme):
         # Generate new 2048 bit account, domain private keys only if not set
         self.register_account()
         try:
-            self.create_key(self.domain_key)
+            self.create_key(self.domain_key, self.domain_key_type)
         except (KeyboardInterrupt, SystemExit) as e:
             raise e
         except Exception as e:
@@ -2,7 +2,7 @@ import hashlib
 import json
 import re
 import sys
-from urllib.request import urlopen, Request  # Python 3
+from concurrent.futures import ThreadPoolExecutor
 
 from .Acme import Acme
 
@@ -10,44 +10,44 @@ from .Acme import Acme
 class AcmeV2(Acme):
     def register_account(self):
         """
-        Generate new 2049 bit account key, domain key if not generated
+        Generate account key and domain key of the configured types if not generated
         Register account key with ACME
         Return:
              dict, directory data from acme server
         """
         try:
             self.log.info('trying to create account key {0}'.format(self.account_key))
-            self.create_key(self.account_key)
+            self.create_key(self.account_key, self.account_key_type)
         except (KeyboardInterrupt, SystemExit) as e:
             raise e
         except Exception as e:
             self.log.error('creating key {0} {1}'.format(type(e).__name__, e))
             sys.exit(1)
         # directory is needed later for order placement
-        directory = urlopen(Request(
-            self.api_url,
-            headers={"Content-Type": "application/jose+json"})
-        ).read().decode('utf8')
-        directory = json.loads(directory)
-        directory['_kid'] = None
-        self.log.info('trying to register acmev2 account')
-        payload = {"termsOfServiceAgreed": True}
-        code, result, headers = self._send_signed_request(
-            url=directory['newAccount'],
-            payload=payload,
-            directory=directory
-        )
-        if code == 201:
-            self.log.info('registered!')
-        elif code == 200:
-            self.log.info('already registered')
+        directory = self.get_directory()
+        directory['_kid'] = self.session.kid
+        if directory['_kid'] is None:
+            self.log.info('trying to register acmev2 account')
+            payload = {"termsOfServiceAgreed": True}
+            code, result, headers = self._send_signed_request(
+                url=directory['newAccount'],
+                payload=payload,
+                directory=directory
+            )
+            if code == 201:
+                self.log.info('registered!')
+            elif code == 200:
+                self.log.info('already registered')
+            else:
+                self.log.error('error registering: {0} {1} {2}'.format(code, result, headers))
+                sys.exit(1)
+            directory['_kid'] = headers['Location']
+            self.session.kid = directory['_kid']
         else:
-            self.log.error('error registering: {0} {1} {2}'.format(code, result, headers))
-            sys.exit(1)
-        directory['_kid'] = headers['Location']
+            self.log.info('using registered account {0}'.format(directory['_kid']))
         try:
             self.log.info('trying to create domain key')
-            self.create_key(self.domain_key)
+            self.create_key(self.domain_key, self.domain_key_type)
         except (KeyboardInterrupt, SystemExit) as e:
             raise e
         except Exception as e:
@@ -68,7 +68,7 @@ class AcmeV2(Acme):
             return False
         self.log.info('certificate signed!')
         self.log.info('downloading certificate')
-        certificate_pem = urlopen(json.loads(result)['certificate']).read().decode('utf8')
+        certificate_pem = self.http.get(json.loads(result)['certificate']).text
         self.log.info('writing result file in {0}'.format(self.cert_path))
         try:
             with open(self.cert_path, 'w') as fd:
@@ -103,34 +103,52 @@ class AcmeV2(Acme):
         self.log.debug(order)
         order = json.loads(order)
         self.log.info('order created')
-        for url in order['authorizations']:
-            auth = json.loads(urlopen(url).read().decode('utf8'))
-            self.log.debug(json.dumps(auth))
-            domain = auth['identifier']['value']
-            self.log.info('verifying domain {0}'.format(domain))
-            challenge = self._get_challenge(auth['challenges'], "http-01")
-            token = re.sub(r"[^A-Za-z0-9_\-]", "_", challenge['token'])
-            thumbprint = self._thumbprint()
-            self.log.info('adding nginx virtual host and completing challenge')
-            try:
-                self._write_challenge(token, thumbprint)
-            except (KeyboardInterrupt, SystemExit) as e:
-                raise e
-            except Exception as e:
-                self.log.error('error adding virtual host {0} {1}'.format(type(e).__name__, e))
-                return False
-            self.log.info('asking acme server to verify challenge')
-            code, result, _ = self._send_signed_request(url=challenge['url'], directory=directory)
-            try:
+        thumbprint = self._thumbprint()
+
+        # write and trigger all the challenges of the order up front, so that they are validated concurrently.
+        pending = []
+        tokens = []
+        try:
+            with ThreadPoolExecutor(max_workers=self._poll_workers(order['authorizations'])) as executor:
+                authorizations = list(executor.map(
+                    lambda x: self.http.get(x).json(), order['authorizations']))
+            for url, auth in zip(order['authorizations'], authorizations):
+                self.log.debug(json.dumps(auth))
+                domain = auth['identifier']['value']
+                if auth.get('status') == "valid":
+                    self.log.info('{0} already verified'.format(domain))
+                    continue
+                self.log.info('verifying domain {0}'.format(domain))
+                challenge = self._get_challenge(auth['challenges'], "http-01")
+                token = re.sub(r"[^A-Za-z0-9_\-]", "_", challenge['token'])
+                self.log.info('adding nginx virtual host and completing challenge')
+                try:
+                    self._write_challenge(token, thumbprint)
+                    tokens.append(token)
+                except (KeyboardInterrupt, SystemExit) as e:
+                    raise e
+                except Exception as e:
+                    self.log.error('error adding virtual host {0} {1}'.format(type(e).__name__, e))
+                    return False
+                self.log.info('asking acme server to verify challenge')
+                code, result, _ = self._send_signed_request(url=challenge['url'], directory=directory)
                 if code > 399:
                     self.log.error("error triggering challenge: {0} {1}".format(code, result))
-                    pass
-                if not self._verify_challenge(url, domain):
-                    pass
-            finally:
-                self._cleanup(['{0}/{1}'.format(self.challenge_dir, token)])
+                    continue
+                pending.append((url, domain))
+
+            # an order takes roughly the time of the slowest authorization
+            if len(pending):
+                with ThreadPoolExecutor(max_workers=self._poll_workers(pending)) as executor:
+                    list(executor.map(lambda x: self._verify_challenge(*x), pending))
+        finally:
+            self._cleanup(['{0}/{1}'.format(self.challenge_dir, token) for token in tokens])
         return self._sign_certificate(order, directory)
 
+    @staticmethod
+    def _poll_workers(items):
+        return max(1, min(len(items), 20))
+
     def solve_dns_challenge(self, directory, client):
         """
         Solve DNS challengesys.exit(1)
@@ -150,7 +168,7 @@ class AcmeV2(Acme):
         order = json.loads(order)
         self.log.info('order created')
         for url in order['authorizations']:
-            auth = json.loads(urlopen(url).read().decode('utf8'))
+            auth = self.http.get(url).json()
             self.log.debug(json.dumps(auth))
             domain = auth['identifier']['value']
             self.log.info('verifying domain {0}'.format(domain))
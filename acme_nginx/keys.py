@@ -0,0 +1,119 @@
+import base64
+
+import OpenSSL
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, rsa, padding
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+
+# key type -> (curve, hash) of the supported elliptic curve keys
+_CURVES = {
+    "p256": (ec.SECP256R1, hashes.SHA256),
+    "p384": (ec.SECP384R1, hashes.SHA384),
+}
+_ALIASES = {
+    "ec256": "p256",
+    "ecdsa-p256": "p256",
+    "prime256v1": "p256",
+    "ec384": "p384",
+    "ecdsa-p384": "p384",
+    "secp384r1": "p384",
+    "rsa": "rsa2048",
+}
+
+
+def parse_key_type(name):
+    """
+    Return the canonical name of a key type
+    Params:
+        name, str, p256, p384 or rsa<bits> e.g. rsa2048, rsa4096. Aliases like ec256 are accepted
+    Return:
+        str, canonical key type
+    Raises ValueError if the key type is not supported
+    """
+    key_type = name.strip().lower()
+    key_type = _ALIASES.get(key_type, key_type)
+    if key_type in _CURVES:
+        return key_type
+    if key_type.startswith("rsa") and key_type[3:].isdigit() and 2048 <= int(key_type[3:]) <= 8192:
+        return key_type
+    raise ValueError("unsupported key type: " + name)
+
+
+def generate_key(key_type):
+    """
+    Generate a private key
+    Params:
+        key_type, str, key type accepted by parse_key_type
+    Return:
+        OpenSSL.crypto.PKey
+    """
+    key_type = parse_key_type(key_type)
+    if key_type in _CURVES:
+        key = ec.generate_private_key(_CURVES[key_type][0]())
+    else:
+        key = rsa.generate_private_key(public_exponent=65537, key_size=int(key_type[3:]))
+    return OpenSSL.crypto.PKey.from_cryptography_key(key)
+
+
+def key_type_of(pkey):
+    """ Return the key type of OpenSSL.crypto.PKey, e.g. p256 or rsa2048 """
+    key = pkey.to_cryptography_key()
+    if isinstance(key, (ec.EllipticCurvePrivateKey, ec.EllipticCurvePublicKey)):
+        for key_type, (curve, _) in _CURVES.items():
+            if key.curve.name == curve.name:
+                return key_type
+        raise ValueError("unsupported curve: " + key.curve.name)
+    return "rsa{0}".format(key.key_size)
+
+
+def _b64(b):
+    return base64.urlsafe_b64encode(b).decode('utf8').replace("=", "")
+
+
+def _int_bytes(value, length=None):
+    if length is None:
+        length = (value.bit_length() + 7) // 8
+    return value.to_bytes(length, "big")
+
+
+def jwk(pkey):
+    """
+    Return JWS algorithm and JWK of the public part of a private key
+    Params:
+        pkey, OpenSSL.crypto.PKey, RSA or elliptic curve private key
+    Return:
+        tuple, (alg, jwk dict)
+    """
+    key = pkey.to_cryptography_key()
+    if isinstance(key, ec.EllipticCurvePrivateKey):
+        key_type = key_type_of(pkey)
+        size = (key.curve.key_size + 7) // 8
+        numbers = key.public_key().public_numbers()
+        return "ES" + key_type[1:], {
+            "crv": "P-" + key_type[1:],
+            "kty": "EC",
+            "x": _b64(_int_bytes(numbers.x, size)),
+            "y": _b64(_int_bytes(numbers.y, size))}
+    numbers = key.public_key().public_numbers()
+    return "RS256", {
+        "e": _b64(_int_bytes(numbers.e)),
+        "kty": "RSA",
+        "n": _b64(_int_bytes(numbers.n))}
+
+
+def sign(pkey, message):
+    """
+    Sign the message as required by the JWS algorithm of the key
+    Params:
+        pkey, OpenSSL.crypto.PKey, RSA or elliptic curve private key
+        message, bytes, message to sign
+    Return:
+        bytes, signature. For elliptic curve keys it's r and s concatenated instead of DER
+    """
+    key = pkey.to_cryptography_key()
+    if isinstance(key, ec.EllipticCurvePrivateKey):
+        hash_algorithm = _CURVES[key_type_of(pkey)][1]
+        size = (key.curve.key_size + 7) // 8
+        r, s = decode_dss_signature(key.sign(message, ec.ECDSA(hash_algorithm())))
+        return _int_bytes(r, size) + _int_bytes(s, size)
+    return key.sign(message, padding.PKCS1v15(), hashes.SHA256())
@@ -0,0 +1,80 @@
+"""
+Compares the cost of preparing the host model for rendering on every reload:
+deep-copying the whole model (the previous approach) against wrapping it in read-only render views.
+
+Run from the repository root:
+    python -m benchmarks.reload_benchmark [location_count ...]
+"""
+import copy
+import gc
+import sys
+import time
+import tracemalloc
+from typing import Callable, List
+
+from nginx_proxy import ProxyConfigData, Host
+from nginx_proxy.config_renderer import ConfigRenderer
+from nginx_proxy.container import Container
+from nginx_proxy.render_view import HostView
+
+LOCATIONS_PER_HOST = 10
+
+
+def build_config(location_count: int) -> ProxyConfigData:
+    config_data = ProxyConfigData()
+    for i in range(0, location_count, LOCATIONS_PER_HOST):
+        host = Host("site%d.example.com" % i, 80)
+        for j in range(LOCATIONS_PER_HOST):
+            container = Container(id="%064x" % (i + j), address="10.%d.%d.%d" % (i // 65536, i // 256 % 256, i % 256),
+                                  port=8080, path="/")
+            container.add_network("%064x" % 1)
+            host.add_container("/location%d" % j, container)
+        config_data.add_host(host)
+    return config_data
+
+
+def deepcopy_model(config_data: ProxyConfigData):
+    # the template renders views, so the copies are wrapped in views too
+    return [HostView(copy.deepcopy(host)) for host in config_data.host_list()]
+
+
+def view_model(config_data: ProxyConfigData):
+    return [HostView(host) for host in config_data.host_list()]
+
+
+def measure(prepare: Callable, config_data: ProxyConfigData, renderer: ConfigRenderer, repeat=3):
+    prepare_times: List[float] = []
+    reload_times: List[float] = []
+    peak = 0
+    for _ in range(repeat):
+        gc.collect()
+        tracemalloc.start()
+        start = time.perf_counter()
+        hosts = prepare(config_data)
+        prepared = time.perf_counter()
+        renderer.render(hosts)
+        end = time.perf_counter()
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        prepare_times.append(prepared - start)
+        reload_times.append(end - start)
+    return min(prepare_times), min(reload_times), peak
+
+
+def main(counts: List[int]):
+    print("{:>10} {:>10} {:>14} {:>14} {:>14}".format("locations", "model", "prepare (ms)", "reload (ms)",
+                                                     "peak alloc (KiB)"))
+    for count in counts:
+        config_data = build_config(count)
+        for name, prepare in (("deepcopy", deepcopy_model), ("view", view_model)):
+            renderer = ConfigRenderer("vhosts_template", {'challenge_dir': '/tmp/acme-challenges/',
+                                                          'client_max_body_size': '1m'})
+            # warm the fragment cache so that only the cost of an unchanged reload is measured
+            renderer.render(prepare(config_data))
+            prepare_time, reload_time, peak = measure(prepare, config_data, renderer)
+            print("{:>10} {:>10} {:>14.2f} {:>14.2f} {:>14.1f}".format(count, name, prepare_time * 1000,
+                                                                     reload_time * 1000, peak / 1024))
+
+
+if __name__ == "__main__":
+    main([int(x) for x in sys.argv[1:]] or [1000, 10000])
@@ -1,9 +1,11 @@
 import signal
 import sys
+import threading
+import time
 import traceback
 
 import docker
-from nginx_proxy.webserver import WebServer
+from nginx_proxy.webserver import WebServer, loadconfig
 
 server = None
 
@@ -22,7 +24,14 @@ def receive_signal(signal_number, frame):
 signal.signal(signal.SIGTERM, receive_signal)
 
 try:
-    client = docker.from_env()
+    config = loadconfig()
+except ValueError as e:
+    print(str(e), file=sys.stderr)
+    sys.exit(1)
+
+try:
+    # connections to the docker daemon are reused by the concurrent inspections, plus one for the event stream.
+    client = docker.from_env(max_pool_size=max(config['scan_workers'], config['event_workers']) + 1)
     client.version()
 except Exception as e:
     print(
@@ -31,38 +40,51 @@ except Exception as e:
     sys.exit(1)
 
 
-def event_loop():
-    for event in client.events(decode=True):
+def watch_events(filters: dict):
+    """
+    Submit the docker events to the event pipeline.
+    When the stream breaks, it's reconnected with `since` the last received event so that no event is missed,
+    and the containers are reconciled in case the daemon no longer had some of the events.
+    """
+    last_event = int(server.scan_time * 1e9)  # nanoseconds
+    retry_delay = 1
+    while True:
         try:
-            event_type = event['Type']
-            if event_type == "network":
-                process_network_event(event['Action'], event)
-            elif event_type == "container":
-                process_container_event(event['Action'], event)
+            for event in client.events(decode=True, filters=filters, since="%d.%09d" % divmod(last_event, 10 ** 9)):
+                retry_delay = 1
+                if event.get('timeNano', last_event + 1) <= last_event:
+                    # already received before reconnecting
+                    continue
+                last_event = event.get('timeNano', last_event)
+                try:
+                    server.event_pipeline.submit(event)
+                except (KeyboardInterrupt, SystemExit) as err:
+                    raise err
+                except Exception as err:
+                    print("Unexpected error :" + err.__class__.__name__ + ' -> ' + str(err), file=sys.stderr)
+                    traceback.print_exc(limit=10)
+            reason = "Event stream closed"
         except (KeyboardInterrupt, SystemExit) as err:
             raise err
         except Exception as err:
-            print("Unexpected error :" + err.__class__.__name__ + ' -> ' + str(err), file=sys.stderr)
-            traceback.print_exc(limit=10)
+            reason = "Event stream failed :" + err.__class__.__name__ + ' -> ' + str(err)
+        print("[Docker Events] " + reason + ", reconnecting in %ds" % retry_delay, file=sys.stderr)
+        time.sleep(retry_delay)
+        retry_delay = min(retry_delay * 2, 30)
+        server.event_pipeline.submit_task(server.reconcile)
 
 
-def process_container_event(action, event):
-    if action == "start":
-        server.update_container(event["id"])
-    elif action == "die":
-        server.remove_container(event["id"])
-
-
-def process_network_event(action, event):
-    if action == "create":
-        pass
-    elif "container" in event["Actor"]["Attributes"]:
-        if action == "disconnect":
-            server.disconnect(network=event["Actor"]["ID"], container=event["Actor"]["Attributes"]["container"])
-        elif action == "connect":
-            server.connect(network=event["Actor"]["ID"], container=event["Actor"]["Attributes"]["container"])
-    elif action == "destroy":
-        pass
+def event_loop():
+    # ask the daemon only for the events that are processed, instead of every exec, health_status, image etc. event
+    label = server.config['proxy_label']
+    if label is None:
+        watch_events({'type': ['container', 'network'], 'event': ['start', 'die', 'connect', 'disconnect']})
+    else:
+        # network events don't carry the labels of the container, so they can't be filtered in the same stream.
+        network_events = threading.Thread(target=watch_events, name="network-events", daemon=True,
+                                          args=({'type': 'network', 'event': ['connect', 'disconnect']},))
+        network_events.start()
+        watch_events({'type': 'container', 'event': ['start', 'die'], 'label': label})
 
 
 try:
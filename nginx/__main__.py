@@ -0,0 +1,50 @@
+import argparse
+import os
+import sys
+from datetime import datetime
+
+from nginx.nginx import Nginx
+
+
+def set_arguments():
+    """
+    Parses command line arguments
+    """
+    parser = argparse.ArgumentParser(prog="python -m nginx",
+                                     description="Manage the versions of the nginx configuration applied by the proxy")
+    parser.add_argument(
+            '--config-dir',
+            dest='config_dir',
+            type=str,
+            default=os.getenv('NGINX_CONFIG_DIR', '/etc/nginx/'),
+            help='nginx configuration directory, default: $NGINX_CONFIG_DIR or /etc/nginx/')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('versions', help='list the stored versions, latest first')
+    rollback = commands.add_parser('rollback', help='test and apply a stored version, then reload nginx')
+    rollback.add_argument(
+            'version',
+            nargs='?',
+            help='version or its unique prefix, default: the version applied before the current one')
+    args = parser.parse_args()
+    try:
+        args.config_versions = int(os.getenv('CONFIG_VERSIONS', '10'))
+    except ValueError:
+        parser.error("Invalid value for environment variable CONFIG_VERSIONS: %r" % os.getenv('CONFIG_VERSIONS'))
+    return args
+
+
+def main():
+    args = set_arguments()
+    config_file = os.path.join(args.config_dir, "conf.d", "default.conf")
+    nginx = Nginx(config_file, config_versions=args.config_versions)
+    if args.command == 'versions':
+        current = nginx.versions.version_of(nginx.last_working_config)
+        for version, applied in nginx.versions.versions():
+            print(version, datetime.fromtimestamp(applied).strftime("%Y-%m-%d %H:%M:%S") +
+                  (" (current)" if version == current else ""))
+        return 0
+    return 0 if nginx.rollback(args.version) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
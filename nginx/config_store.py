@@ -0,0 +1,142 @@
+import contextlib
+import fcntl
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import List, Tuple, Union
+
+
+class ConfigStore:
+    """
+    The last applied configurations, stored on disk by the hash of their content.
+    -- `<directory>/<version>.conf` contains the configuration, a configuration applied again reuses its file.
+    -- `<directory>/history` lists `<version> <time applied>`, oldest first, and is replaced atomically.
+    Only the last `keep` distinct versions are retained. The history is read from disk on each access,
+    so that a rollback from the command line (`python -m nginx`) is seen by the running proxy.
+    `locked` serializes the changes across the threads and the processes using the store.
+    """
+    history_file = "history"
+
+    def __init__(self, directory: str, keep: int = 10):
+        self.directory = directory
+        self.keep = max(keep, 1)
+        self.lock = threading.RLock()
+        self.lock_depth = 0
+        self.lock_fd = None
+        os.makedirs(directory, exist_ok=True)
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Exclusive lock on the store, held with flock on the directory so that it's also exclusive of other
+        processes. Reentrant within a thread.
+        """
+        with self.lock:
+            if self.lock_depth == 0:
+                self.lock_fd = os.open(self.directory, os.O_RDONLY)
+                fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+            self.lock_depth += 1
+            try:
+                yield
+            finally:
+                self.lock_depth -= 1
+                if self.lock_depth == 0:
+                    # closing it releases the flock
+                    os.close(self.lock_fd)
+                    self.lock_fd = None
+
+    def _read_history(self) -> List[Tuple[str, float]]:
+        history = []
+        try:
+            with open(os.path.join(self.directory, self.history_file)) as file:
+                for line in file:
+                    fields = line.split()
+                    if len(fields) == 2 and os.path.exists(self._file_of(fields[0])):
+                        history.append((fields[0], float(fields[1])))
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                print("[Config Store] Ignoring the history :", e.__class__.__name__ + ' -> ' + str(e),
+                      file=sys.stderr)
+        return history
+
+    @staticmethod
+    def version_of(config_str: str) -> str:
+        return hashlib.sha256(config_str.encode("utf-8")).hexdigest()[:16]
+
+    def _file_of(self, version: str) -> str:
+        return os.path.join(self.directory, version + ".conf")
+
+    def _write_atomic(self, file_path, content: str):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(content)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, file_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def save(self, config_str: str) -> str:
+        """
+        Record the configuration as the latest applied version.
+        :return: version of the configuration
+        """
+        version = self.version_of(config_str)
+        with self.locked():
+            if not os.path.exists(self._file_of(version)):
+                self._write_atomic(self._file_of(version), config_str)
+            history = [x for x in self._read_history() if x[0] != version]
+            history.append((version, time.time()))
+            removed = history[:-self.keep]
+            history = history[-self.keep:]
+            self._write_atomic(os.path.join(self.directory, self.history_file),
+                               "".join("%s %.3f\n" % x for x in history))
+            for old_version, _ in removed:
+                try:
+                    os.remove(self._file_of(old_version))
+                except OSError:
+                    pass
+        return version
+
+    def versions(self) -> List[Tuple[str, float]]:
+        """
+        :return: (version, time applied) of the stored configurations, latest first
+        """
+        with self.lock:
+            return list(reversed(self._read_history()))
+
+    def latest(self) -> Union[str, None]:
+        """
+        :return: the version applied last
+        """
+        with self.lock:
+            history = self._read_history()
+            return history[-1][0] if len(history) else None
+
+    def previous(self) -> Union[str, None]:
+        """
+        :return: the version applied before the latest one
+        """
+        with self.lock:
+            history = self._read_history()
+            return history[-2][0] if len(history) > 1 else None
+
+    def get(self, version: str) -> Union[str, None]:
+        """
+        :param version: version or a unique prefix of it
+        :return: the configuration or None if it isn't stored
+        """
+        with self.lock:
+            matches = [x[0] for x in self._read_history() if x[0].startswith(version)]
+        if len(matches) != 1:
+            return None
+        try:
+            with open(self._file_of(matches[0])) as file:
+                return file.read()
+        except OSError:
+            return None
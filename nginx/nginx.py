@@ -1,28 +1,64 @@
-import difflib
+import glob
 import os
 import pathlib
 import random
+import re
 import socket
 import string
 import subprocess
 import sys
+import tempfile
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 from os import path
-from typing import Union, Tuple
+from typing import Union, Tuple, Dict, List, Set
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from nginx import Url
+from nginx.config_store import ConfigStore
+from nginx.nginx_process import NginxProcess
+from nginx.reload_monitor import ReloadMonitor
 
 
 class Nginx:
     command_config_test = ["nginx", "-t"]
     command_start = ["nginx"]
     command_reload = ["nginx", "-s", "reload"]
+    # domain verification results are reused for these many seconds
+    verified_ttl = 600
+    unverified_ttl = 120
 
-    def __init__(self, config_file_path, challenge_dir="/tmp/acme-challenges/"):
+    def __init__(self, config_file_path, challenge_dir="/tmp/acme-challenges/", verification_workers=16,
+                 verification_deadline=15, main_config_path=None, max_draining_generations=3, drain_wait=30,
+                 config_versions=10):
         self.config_file_path = config_file_path
+        # main configuration of nginx, that includes the config file. Defaults to nginx.conf above conf.d
+        self.main_config_path = main_config_path if main_config_path else \
+            path.join(path.dirname(path.dirname(path.abspath(config_file_path))), "nginx.conf")
+        # the candidate configuration is tested from uniquely named files like these before it replaces the
+        # config file. They are hidden so that they never match the include patterns of the running configuration.
+        self.staged_file_prefix = "." + path.basename(config_file_path) + "."
+        self.staged_file_suffix = ".staged"
+        # the applied configurations, to roll back to. Hidden directory, not matched by the include patterns.
+        self.versions = ConfigStore(path.join(path.dirname(path.abspath(config_file_path)), ".versions"),
+                                    keep=config_versions)
+        # signals the running nginx master directly
+        self.process = NginxProcess(NginxProcess.pid_file_of(self.main_config_path))
+        self.monitor = ReloadMonitor(self.process, ReloadMonitor.error_log_of(self.main_config_path),
+                                     max_draining_generations=max_draining_generations, drain_wait=drain_wait)
+        self.process.monitor = self.monitor
         self.challenge_dir = challenge_dir
+        self.verification_workers = verification_workers
+        self.verification_deadline = verification_deadline
+        # domain -> (owned by this machine, time of verification)
+        self.verification_cache: Dict[str, Tuple[bool, float]] = {}
+        self.verification_lock = threading.Lock()
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=verification_workers, pool_maxsize=verification_workers)
+        self.http.mount("http://", adapter)
 
         if path.exists(config_file_path):
             with open(config_file_path) as file:
@@ -30,7 +66,6 @@ class Nginx:
         else:
             self.last_working_config = ""
 
-        self.config_stack = [self.last_working_config]
         self.last_error = None
         if not os.path.exists(challenge_dir):
             pathlib.Path(self.challenge_dir).mkdir(parents=True)
@@ -65,15 +100,109 @@ class Nginx:
         :param config_str: nginx config to start server with
         :return: true if force start is successful, otherwise false.
         """
-        with open(self.config_file_path, "w") as file:
-            file.write(config_str)
-        if not self.start():
-            with open(self.config_file_path, "w") as file:
-                file.write(self.last_working_config)
-            return False
-        else:
-            self.last_working_config = config_str
-            return True
+        with self.versions.locked():
+            self._write_atomic(self.config_file_path, config_str)
+            if not self.start():
+                self._write_atomic(self.config_file_path, self.last_working_config)
+                return False
+            else:
+                self.last_working_config = config_str
+                self.versions.save(config_str)
+                return True
+
+    @staticmethod
+    def _write_atomic(file_path, content):
+        """
+        Replace the file with the content, so that a reader sees either the old or the complete new content.
+        """
+        directory = path.dirname(path.abspath(file_path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix="." + path.basename(file_path) + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(content)
+                file.flush()
+                # mkstemp creates the file readable only by the owner
+                os.fchmod(file.fileno(), 0o644)
+                os.fsync(file.fileno())
+            os.replace(temp_path, file_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        Nginx._fsync_directory(directory)
+
+    @staticmethod
+    def _fsync_directory(directory):
+        """ Persist the renames in the directory """
+        directory_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+    def _staging_main_config(self, staged_file_path) -> Union[str, None]:
+        """
+        Main configuration that includes the staged file instead of the config file, along with the other
+        files included by the running configuration.
+        :return: the staging main configuration or None if the config file isn't included from the main config
+        """
+        try:
+            with open(self.main_config_path) as file:
+                main_config = file.read()
+        except OSError:
+            return None
+        config_file = path.realpath(self.config_file_path)
+        prefix = path.dirname(self.main_config_path)
+        replaced = False
+
+        def replace(match):
+            nonlocal replaced
+            pattern = match.group(1).strip("'\"")
+            files = sorted(glob.glob(pattern if path.isabs(pattern) else path.join(prefix, pattern)))
+            if config_file not in [path.realpath(x) for x in files]:
+                return match.group(0)
+            replaced = True
+            return " ".join("include %s;" % (staged_file_path if path.realpath(x) == config_file else x)
+                            for x in files)
+
+        staging_config = re.sub(r"\binclude\s+([^;\s]+)\s*;", replace, main_config)
+        return staging_config if replaced else None
+
+    def stage_config(self, config_str) -> Tuple[bool, Union[str, None]]:
+        """
+        Test the configuration with `nginx -t` against a staging copy of the main configuration,
+        and replace the config file atomically only if the test passes. The running configuration isn't touched
+        by a failing configuration.
+        :return: (whether the config file was replaced, error reported by nginx)
+        """
+        fd, staged_file_path = tempfile.mkstemp(dir=path.dirname(path.abspath(self.config_file_path)),
+                                                prefix=self.staged_file_prefix, suffix=self.staged_file_suffix)
+        staging_main_config_path = None
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(config_str)
+                file.flush()
+                os.fchmod(file.fileno(), 0o644)
+                os.fsync(file.fileno())
+            staging_config = self._staging_main_config(staged_file_path)
+            if staging_config is not None:
+                fd, staging_main_config_path = tempfile.mkstemp(dir=path.dirname(self.main_config_path),
+                                                                prefix=".nginx-proxy-staging.", suffix=".conf")
+                with os.fdopen(fd, "w") as file:
+                    file.write(staging_config)
+                test_result = subprocess.run(Nginx.command_config_test + ["-c", staging_main_config_path],
+                                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                if test_result.returncode != 0:
+                    return False, test_result.stderr.decode("utf-8")
+            else:
+                print("[WARNING] " + self.config_file_path + " is not included from " + self.main_config_path +
+                      ", the configuration is applied without testing it first", file=sys.stderr)
+            os.replace(staged_file_path, self.config_file_path)
+            self._fsync_directory(path.dirname(path.abspath(self.config_file_path)))
+            return True, None
+        finally:
+            for file_path in (staged_file_path, staging_main_config_path):
+                if file_path is not None and path.exists(file_path):
+                    os.remove(file_path)
 
     def update_config(self, config_str) -> bool:
         """
@@ -81,55 +210,147 @@ class Nginx:
         :param config_str: string containing configuration to be written into config file
         :return: true if the new config was used, false if error or if the new configuration is same as previous
         """
-        if config_str == self.last_working_config:
-            print("Configuration not changed, skipping nginx reload")
-            return False
+        # held from the comparison until the version is saved, so that an update from another thread or
+        # process, e.g. a rollback from the command line, isn't interleaved with it.
+        with self.versions.locked():
+            # compared with the version applied last, possibly by a rollback from the command line
+            applied = self.versions.latest()
+            if (self.versions.version_of(config_str) == applied) if applied is not None \
+                    else config_str == self.last_working_config:
+                print("Configuration not changed, skipping nginx reload")
+                return False
 
-        with open(self.config_file_path, "w") as file:
-            file.write(config_str)
+            staged, data = self.stage_config(config_str)
+            if staged:
+                self.monitor.wait_for_drain()
+                result, data = self.reload(return_error=True)
+                self.monitor.report()
+            else:
+                result = False
+            if not result:
+                self.report_failure(config_str, data)
+                if staged:
+                    # the last version that nginx accepted, the config file read on startup if none is stored.
+                    latest = self.versions.latest()
+                    restored = self.versions.get(latest) if latest is not None else None
+                    if restored is None:
+                        restored = self.last_working_config
+                    print("ERROR: New change made nginx to fail. Thus it's rolled back to version %s" % latest,
+                          file=sys.stderr)
+                    self._write_atomic(self.config_file_path, restored)
+                    self.last_working_config = restored
+                else:
+                    print("ERROR: New change failed the nginx config test. Thus it's not applied", file=sys.stderr)
+                return False
+            else:
+                version = self.versions.save(config_str)
+                print("Nginx Reloaded Successfully, config version: " + version)
+                self.last_working_config = config_str
+                return True
 
-        result, data = self.reload(return_error=True)
-        if not result:
-            diff = str.join("\n", difflib.unified_diff(self.last_working_config.splitlines(),
-                                                       config_str.splitlines(),
-                                                       fromfile='Old Config',
-                                                       tofile='New Config',
-                                                       lineterm='\n'))
-            print(diff, file=sys.stderr)
-            if data is not None:
-                print(data, file=sys.stderr)
-            print("ERROR: New change made nginx to fail. Thus it's rolled back", file=sys.stderr)
-            with open(self.config_file_path, "w") as file:
-                file.write(self.last_working_config)
-            return False
-        else:
-            print("Nginx Reloaded Successfully")
-            self.last_working_config = config_str
-            return True
+    def rollback(self, version: str = None) -> bool:
+        """
+        Apply a previously applied configuration from the version store, without rendering it again.
+        The configuration is still tested before it replaces the running one.
+        :param version: version or its unique prefix, defaults to the version applied before the current one
+        :return: true if the version was applied
+        """
+        with self.versions.locked():
+            if version is None:
+                version = self.versions.previous()
+                if version is None:
+                    print("[ERROR] No previous config version to roll back to", file=sys.stderr)
+                    return False
+            config_str = self.versions.get(version)
+            if config_str is None:
+                print("[ERROR] Config version not found: " + version, file=sys.stderr)
+                return False
+            print("Rolling back to config version: " + version)
+            return self.update_config(config_str)
+
+    def report_failure(self, config_str, error: Union[str, None]):
+        """
+        Print the error, and for each location of the config file named in it, the directive at that line
+        and the server block containing it.
+        """
+        if error is None:
+            return
+        print(error, file=sys.stderr)
+        config_dir = path.dirname(path.realpath(self.config_file_path))
+        lines = None
+        for file_path, line_number in set(re.findall(r"\bin (\S+):([0-9]+)", error)):
+            file_path = path.realpath(file_path)
+            staged = path.dirname(file_path) == config_dir and path.basename(file_path).startswith(
+                self.staged_file_prefix) and file_path.endswith(self.staged_file_suffix)
+            if not staged and file_path != path.realpath(self.config_file_path):
+                continue
+            if lines is None:
+                lines = config_str.splitlines()
+            line_number = int(line_number)
+            if not 0 < line_number <= len(lines):
+                continue
+            print("  line %d: %s" % (line_number, lines[line_number - 1].strip()), file=sys.stderr)
+            block = self._enclosing_block(lines, line_number)
+            if block is None:
+                continue
+            start, end = block
+            names = [x.strip() for x in lines[start - 1:end]
+                     if re.match(r"\s*(server_name|listen)\s", x)]
+            print("  in block at lines %d-%d: %s %s" % (start, end, lines[start - 1].strip(), " ".join(names)),
+                  file=sys.stderr)
+
+    @staticmethod
+    def _enclosing_block(lines: List[str], line_number: int) -> Union[Tuple[int, int], None]:
+        """
+        :return: (first line, last line) of the outermost `server` block containing the line,
+                 or of the top level block if the line isn't within a server block.
+        """
+        stack: List[Tuple[int, bool]] = []  # (line opening the block, whether it's a server block)
+        block = None
+        for number, line in enumerate(lines, start=1):
+            line = line.split("#", 1)[0]
+            if number == line_number and block is None and len(stack):
+                servers = [x[0] for x in stack if x[1]]
+                block = servers[0] if len(servers) else stack[0][0]
+            for char in line:
+                if char == "{":
+                    stack.append((number, re.match(r"\s*server\s*\{", line) is not None))
+                elif char == "}" and len(stack):
+                    opened, _ = stack.pop()
+                    if block is not None and opened == block:
+                        return block, number
+            if number == line_number and block is None and len(stack):
+                # the line opens a block
+                servers = [x[0] for x in stack if x[1]]
+                block = servers[0] if len(servers) else stack[0][0]
+        return (block, len(lines)) if block is not None else None
 
     def reload(self, return_error=False) -> Union[bool, Tuple[bool, Union[str, None]]]:
         """
         Reload nginx so that new configurations are applied.
+        The running master is signalled directly and the reload is complete once it has started new workers.
+        `nginx -s reload` is used only when the master process can't be found.
         :return: true if nginx reload was successful, false otherwise
         """
-        reload_result = subprocess.run(Nginx.command_reload, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if reload_result.returncode != 0:
-            if return_error:
-                return False, reload_result.stderr.decode('utf-8')
-            else:
-                print("Nginx reload failed with exit code ", file=sys.stderr)
-                print(reload_result.stderr.decode("utf-8"), file=sys.stderr)
-                result = False
+        if self.process.master_pid() is not None:
+            result, error = self.process.reload()
+            if result and self.process.last_reload_latency is not None:
+                print("Nginx started new workers in %.1f ms" % (self.process.last_reload_latency * 1000))
         else:
-            result = True
+            reload_result = subprocess.run(Nginx.command_reload, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            result = reload_result.returncode == 0
+            error = None if result else reload_result.stderr.decode('utf-8')
 
         if return_error:
-            return result, None
-        else:
-            return result
+            return result, error
+        if not result:
+            print("Nginx reload failed :", error, file=sys.stderr)
+        return result
 
     def verify_domain(self, _domain: list or str):
         """Verify that a domain is owned by the current machine.
+        The domains are checked concurrently, and the whole check gives up after `verification_deadline` seconds.
+        Recent results are reused for `verified_ttl` and `unverified_ttl` seconds.
         :param _domain: A list of domains to verify.
         :returns: True if the domain is owned by the current machine, False otherwise.
         """
@@ -138,6 +359,34 @@ class Nginx:
         # Filter out any invalid domains
         domains = [x for x in domains if Url.is_valid_hostname(x)]
 
+        success = []
+        unknown = []
+        now = time.monotonic()
+        with self.verification_lock:
+            for domain in domains:
+                cached = self.verification_cache.get(domain)
+                if cached is not None and now - cached[1] < (self.verified_ttl if cached[0] else self.unverified_ttl):
+                    if cached[0]:
+                        success.append(domain)
+                else:
+                    unknown.append(domain)
+
+        if len(unknown):
+            owned = self._probe_domains(unknown)
+            now = time.monotonic()
+            with self.verification_lock:
+                for domain, result in owned.items():
+                    self.verification_cache[domain] = (result, now)
+            success.extend([x for x in unknown if owned.get(x)])
+
+        # return the result
+        return len(success) > 0 if type(_domain) is str else success
+
+    def _probe_domains(self, domains: list) -> Dict[str, bool]:
+        """
+        Request a challenge token from each of the domains.
+        :return: domain -> whether the domain is owned by this machine, for the domains checked before deadline.
+        """
         # generate a random challenge token
         unique_challenge_name = "".join(random.choices(string.ascii_letters + string.digits, k=32))
         challenge_token = "".join(random.choices(string.ascii_letters + string.digits, k=256))
@@ -147,35 +396,102 @@ class Nginx:
         with open(challenge_file, mode="wt") as file_descriptor:
             file_descriptor.write(challenge_token)
 
-        # try to access the challenge token from each domain
-        success = []
-
-        for domain in domains:
+        def probe(domain):
             try:
                 url = f"http://{domain}/.well-known/acme-challenge/{unique_challenge_name}"
-                response = requests.get(url, allow_redirects=False, timeout=3)
+                response = self.http.get(url, allow_redirects=False, timeout=3)
                 if response.status_code == 200 and response.content.decode("utf-8") == challenge_token:
-                    success.append(domain)
-                    continue
+                    return True
                 print(f"[ERROR] [{domain}] Not owned by this machine: Status Code[{response.status_code}] -> {url}",
                       file=sys.stderr)
-                continue
             except requests.exceptions.RequestException as err:
                 print(f"[ERROR] Domain is not owned by this machine: {err}", file=sys.stderr)
-                continue
+            return False
+
+        executor = ThreadPoolExecutor(max_workers=min(self.verification_workers, len(domains)),
+                                      thread_name_prefix="verify-domain")
+        futures = {executor.submit(probe, domain): domain for domain in domains}
+        done, not_done = wait(futures, timeout=self.verification_deadline)
+        executor.shutdown(wait=False, cancel_futures=True)
 
         # remove the challenge file from the current machine
         os.remove(challenge_file)
 
-        # return the result
-        return len(success) > 0 if type(_domain) is str else success
+        if len(not_done):
+            print("[ERROR] Domain verification timed out for:", [futures[x] for x in not_done], file=sys.stderr)
+        return {futures[x]: x.result() for x in done}
+
+    def _included_configs(self) -> List[str]:
+        """
+        :return: contents of the main configuration and the files it includes directly
+        """
+        try:
+            with open(self.main_config_path) as file:
+                main_config = file.read()
+        except OSError:
+            return [self.last_working_config]
+        configs = [main_config]
+        prefix = path.dirname(self.main_config_path)
+        for pattern in re.findall(r"\binclude\s+([^;\s]+)\s*;", main_config):
+            pattern = pattern.strip("'\"")
+            for file_path in sorted(glob.glob(pattern if path.isabs(pattern) else path.join(prefix, pattern))):
+                try:
+                    with open(file_path) as file:
+                        configs.append(file.read())
+                except OSError:
+                    pass
+        return configs
+
+    def listen_addresses(self) -> Set[Tuple[str, int]]:
+        """
+        :return: (host, port) to connect to, for each of the `listen` directives of the configuration
+        """
+        addresses = set()
+        for config in self._included_configs():
+            for listen in re.findall(r"(?:^|[{;])\s*listen\s+([^;\s]+)", config, re.MULTILINE):
+                if listen.startswith("unix:"):
+                    continue
+                match = re.match(r"^(?:\[([^\]]+)\]:|([^:\[]+):)?([0-9]+)$", listen)
+                if match is None:
+                    # address without port
+                    addresses.add((listen.strip("[]"), 80))
+                    continue
+                host = match.group(1) or match.group(2) or "127.0.0.1"
+                if host in ("*", "0.0.0.0"):
+                    host = "127.0.0.1"
+                elif host == "::":
+                    host = "::1"
+                addresses.add((host, int(match.group(3))))
+        return addresses
 
-    def wait(self):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        result = sock.connect_ex(('127.0.0.1', 80))
-        while result != 0:
-            print("Waiting for nginx process to be ready")
-            time.sleep(1)
-            result = sock.connect_ex(('127.0.0.1', 80))
-        sock.close()
-        print("Nginx is alive")
+    def wait(self, timeout=30.0) -> bool:
+        """
+        Wait until the nginx master is running and accepts connections on each of the ports it listens on.
+        Checks are repeated with exponential backoff, starting at a few milliseconds.
+        :return: true if nginx is ready, false if it isn't ready within the timeout
+        """
+        start = time.monotonic()
+        deadline = start + timeout
+        delay = 0.005
+        pending = self.listen_addresses() or {("127.0.0.1", 80)}
+        master = None
+        while True:
+            if master is None:
+                master = self.process.master_pid()
+            if master is not None:
+                for address in list(pending):
+                    try:
+                        connect_timeout = min(0.5, max(deadline - time.monotonic(), 0.01))
+                        socket.create_connection(address, timeout=connect_timeout).close()
+                        pending.discard(address)
+                    except OSError:
+                        pass
+                if not len(pending):
+                    print("Nginx is alive in %.1f ms" % ((time.monotonic() - start) * 1000))
+                    return True
+            if time.monotonic() + delay > deadline:
+                print("Nginx is not ready after %g seconds, master pid: %s, not listening on: %s" % (
+                    timeout, master, sorted(pending)), file=sys.stderr)
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
@@ -0,0 +1,118 @@
+import os
+import re
+import signal
+import time
+from typing import Set, Tuple, Union
+
+
+class NginxProcess:
+    """
+    Controls the running nginx master process by sending signals to it directly, instead of spawning `nginx -s`.
+    The master is found from its pid file. A reload is confirmed when a new generation of worker processes
+    is started by the master, which is observed from /proc.
+    """
+
+    def __init__(self, pid_file="/var/run/nginx.pid", reload_timeout=10.0, poll_interval=0.005):
+        self.pid_file = pid_file
+        self.reload_timeout = reload_timeout
+        self.poll_interval = poll_interval
+        # seconds between sending the reload signal and the new workers being started, for the last reload
+        self.last_reload_latency: Union[float, None] = None
+        # ReloadMonitor, to detect the rejected configuration from the error log without waiting for the timeout
+        self.monitor = None
+
+    @staticmethod
+    def pid_file_of(main_config_path, default="/var/run/nginx.pid") -> str:
+        """
+        Read the pid file location from the `pid` directive of the main configuration.
+        """
+        try:
+            with open(main_config_path) as file:
+                match = re.search(r"^\s*pid\s+([^;\s]+)\s*;", file.read(), re.MULTILINE)
+                if match:
+                    return match.group(1)
+        except OSError:
+            pass
+        return default
+
+    def master_pid(self) -> Union[int, None]:
+        """
+        :return: pid of the running nginx master or None if it's not running
+        """
+        try:
+            with open(self.pid_file) as file:
+                pid = int(file.read().strip())
+            os.kill(pid, 0)
+            return pid
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def workers(master_pid: int) -> Union[Set[int], None]:
+        """
+        :return: pids of the child processes of the master, or None if it can't be determined
+        """
+        try:
+            entries = os.listdir("/proc")
+        except OSError:
+            return None
+        children = set()
+        for entry in entries:
+            if not entry.isdigit():
+                continue
+            try:
+                with open("/proc/" + entry + "/stat") as file:
+                    stat = file.read()
+            except OSError:
+                continue
+            # the process name is in parentheses and may contain spaces, the parent pid is the second field after it
+            fields = stat[stat.rfind(")") + 2:].split()
+            if len(fields) > 1 and fields[1] == str(master_pid):
+                children.add(int(entry))
+        return children
+
+    def signal(self, signal_number) -> bool:
+        pid = self.master_pid()
+        if pid is None:
+            return False
+        os.kill(pid, signal_number)
+        return True
+
+    def reload(self) -> Tuple[bool, Union[str, None]]:
+        """
+        Send SIGHUP to the master and wait until it starts new workers with the new configuration.
+        :return: (whether the reload completed, error message)
+        """
+        pid = self.master_pid()
+        if pid is None:
+            return False, "nginx master process is not running (pid file: " + self.pid_file + ")"
+        old_workers = self.workers(pid)
+        if self.monitor is not None:
+            self.monitor.begin()
+        start = time.monotonic()
+        os.kill(pid, signal.SIGHUP)
+        if old_workers is None:
+            # can't observe the workers, the signal being delivered is all we know.
+            self.last_reload_latency = None
+            return True, None
+        deadline = start + self.reload_timeout
+        while time.monotonic() < deadline:
+            workers = self.workers(pid)
+            if workers is not None and len(workers.difference(old_workers)):
+                self.last_reload_latency = time.monotonic() - start
+                return True, None
+            if self.master_pid() != pid:
+                return False, "nginx master process exited during reload"
+            errors = self.monitor.errors() if self.monitor is not None else []
+            if len(errors):
+                return False, "\n".join(errors)
+            time.sleep(self.poll_interval)
+        return False, "nginx didn't start new workers within %.1f seconds, " \
+                      "the configuration was probably rejected" % self.reload_timeout
+
+    def stop(self) -> bool:
+        """ Graceful shutdown """
+        return self.signal(signal.SIGQUIT)
+
+    def reopen_logs(self) -> bool:
+        return self.signal(signal.SIGUSR1)
@@ -0,0 +1,148 @@
+import os
+import re
+import sys
+import time
+from typing import List, Tuple, Union
+
+from nginx.nginx_process import NginxProcess
+
+
+class ReloadMonitor:
+    """
+    Watches the effects of the reloads.
+    -- the error log is followed, so that a reload rejected by the master e.g. for a missing certificate is reported
+       with its error as soon as it's logged. When the error log goes to stderr, only the workers are watched.
+    -- old workers keep running after a reload until their connections are closed, e.g. long-lived websockets.
+       Their generations and memory are reported, and a reload waits while too many generations are draining.
+    """
+    # the master logs why it rejected the configuration as emerg
+    error_pattern = re.compile(r"\[emerg\]")
+
+    def __init__(self, process: NginxProcess, error_log: Union[str, None], max_draining_generations=3,
+                 drain_wait=30.0):
+        self.process = process
+        self.error_log = error_log
+        self.max_draining_generations = max_draining_generations
+        self.drain_wait = drain_wait
+        self.log_offset = 0
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        self.clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    @staticmethod
+    def error_log_of(main_config_path) -> Union[str, None]:
+        """
+        Read the error log location from the main configuration.
+        :return: path of the error log, or None if it's not a regular file that can be followed
+        """
+        try:
+            with open(main_config_path) as file:
+                match = re.search(r"^\s*error_log\s+([^;\s]+)", file.read(), re.MULTILINE)
+        except OSError:
+            return None
+        if match is None or match.group(1) in ("stderr", "off") or match.group(1).startswith("syslog:"):
+            return None
+        log_path = match.group(1)
+        if not os.path.isabs(log_path):
+            log_path = os.path.join(os.path.dirname(main_config_path), log_path)
+        # e.g. the official image links the error log to /dev/stderr
+        if os.path.realpath(log_path).startswith(("/dev/", "/proc/")):
+            return None
+        return log_path
+
+    def begin(self):
+        """
+        Called before the reload signal, so that only the errors logged after it are considered.
+        """
+        if self.error_log is None:
+            return
+        try:
+            self.log_offset = os.path.getsize(self.error_log)
+        except OSError:
+            self.log_offset = 0
+
+    def errors(self) -> List[str]:
+        """
+        :return: errors logged since `begin` or the last call
+        """
+        if self.error_log is None:
+            return []
+        try:
+            with open(self.error_log, "rb") as file:
+                file.seek(0, os.SEEK_END)
+                if file.tell() < self.log_offset:
+                    # rotated
+                    self.log_offset = 0
+                file.seek(self.log_offset)
+                data = file.read()
+        except OSError:
+            return []
+        # incomplete last line is read again next time
+        complete = data[:data.rfind(b"\n") + 1]
+        self.log_offset += len(complete)
+        return [x for x in complete.decode("utf-8", "replace").splitlines() if self.error_pattern.search(x)]
+
+    def _process_info(self, pid: int) -> Union[Tuple[int, int, str], None]:
+        """
+        :return: (start time in clock ticks, resident memory in bytes, command line) of the process
+        """
+        try:
+            with open("/proc/%d/stat" % pid) as file:
+                stat = file.read()
+            with open("/proc/%d/statm" % pid) as file:
+                resident = int(file.read().split()[1]) * self.page_size
+            with open("/proc/%d/cmdline" % pid, "rb") as file:
+                cmdline = file.read().replace(b"\0", b" ").decode("utf-8", "replace").strip()
+        except (OSError, IndexError, ValueError):
+            return None
+        return int(stat[stat.rfind(")") + 2:].split()[19]), resident, cmdline
+
+    def draining(self) -> List[Tuple[int, int]]:
+        """
+        Old workers that are still serving their connections, grouped by the reload that replaced them.
+        :return: (number of processes, resident memory in bytes) of each draining generation, oldest first
+        """
+        pid = self.process.master_pid()
+        workers = self.process.workers(pid) if pid is not None else None
+        if not workers:
+            return []
+        draining = []
+        for worker in workers:
+            info = self._process_info(worker)
+            if info is not None and "shutting down" in info[2]:
+                draining.append(info)
+        # workers of a generation are started together, generations are at least a reload apart.
+        generations: List[List[int]] = []
+        last_start = None
+        for start, resident, _ in sorted(draining):
+            if last_start is None or start - last_start > self.clock_ticks // 10:
+                generations.append([0, 0])
+            generations[-1][0] += 1
+            generations[-1][1] += resident
+            last_start = start
+        return [(x[0], x[1]) for x in generations]
+
+    def report(self):
+        generations = self.draining()
+        if len(generations):
+            print("[Reload Monitor] %d old worker generation(s) draining: %d process(es), %.1f MiB resident" % (
+                len(generations), sum(x[0] for x in generations), sum(x[1] for x in generations) / 1048576))
+
+    def wait_for_drain(self):
+        """
+        Delay the reload while `max_draining_generations` or more generations of old workers are draining,
+        for at most `drain_wait` seconds.
+        """
+        generations = self.draining()
+        if len(generations) < self.max_draining_generations:
+            return
+        print("[Reload Monitor] %d old worker generations still draining, delaying reload" % len(generations),
+              file=sys.stderr)
+        deadline = time.monotonic() + self.drain_wait
+        delay = 0.1
+        while time.monotonic() < deadline:
+            time.sleep(min(delay, max(deadline - time.monotonic(), 0)))
+            delay = min(delay * 2, 2)
+            if len(self.draining()) < self.max_draining_generations:
+                return
+        print("[Reload Monitor] Old workers didn't drain within %g seconds, reloading anyway" % self.drain_wait,
+              file=sys.stderr)
@@ -0,0 +1,202 @@
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Set, Tuple, Union
+
+from OpenSSL import crypto
+
+
+class Certificate:
+    """
+    Metadata of a certificate in the certs directory along with its private key.
+    `id` is the file name without extension, which is what the nginx configuration refers to.
+    """
+
+    def __init__(self, cert_id: str, not_after: datetime, names: Set[str], state: Tuple):
+        self.id: str = cert_id
+        self.not_after: datetime = not_after
+        self.names: Set[str] = names  # common name and the subject alternative names
+        self.state: Tuple = state  # (mtime, size) of the certificate and the key file
+
+    @property
+    def self_signed(self) -> bool:
+        return self.id.endswith(".selfsigned")
+
+    @property
+    def companion(self) -> bool:
+        """
+        Whether it's the RSA certificate served along with the ECDSA certificate `<id>` for older clients.
+        """
+        return self.id.endswith(".rsa")
+
+    def __repr__(self):
+        return str({"id": self.id, "not_after": self.not_after, "names": self.names})
+
+
+class CertificateStore:
+    """
+    Index of the certificates in `<ssl_path>/certs` whose private key is present in `<ssl_path>/private`.
+    Certificates are parsed once, and parsed again only when the mtime or size of the files change.
+    -- `refresh` re-checks the files, at most once per `refresh_interval` seconds unless forced.
+    -- `update` re-reads a single certificate, and is called after the certificate files are written.
+    -- `find` returns the certificate covering a hostname by looking up the name and its wildcard in the index.
+    """
+
+    def __init__(self, ssl_path: str, refresh_interval: float = 30):
+        self.cert_dir = os.path.join(ssl_path, "certs")
+        self.key_dir = os.path.join(ssl_path, "private")
+        self.refresh_interval = refresh_interval
+        self.lock = threading.RLock()
+        self.certificates: Dict[str, Certificate] = {}
+        self.names: Dict[str, Set[str]] = {}  # name or wildcard name -> ids of the certificates for it
+        self.last_refresh: Union[float, None] = None
+        self.refresh(force=True)
+
+    def cert_file(self, cert_id: str) -> str:
+        return os.path.join(self.cert_dir, cert_id + ".crt")
+
+    def key_file(self, cert_id: str) -> str:
+        return os.path.join(self.key_dir, cert_id + ".key")
+
+    def _state(self, cert_id: str) -> Union[Tuple, None]:
+        try:
+            cert_stat = os.stat(self.cert_file(cert_id))
+            key_stat = os.stat(self.key_file(cert_id))
+        except OSError:
+            return None
+        return cert_stat.st_mtime_ns, cert_stat.st_size, key_stat.st_mtime_ns, key_stat.st_size
+
+    def _load(self, cert_id: str, state: Tuple) -> Union[Certificate, None]:
+        try:
+            with open(self.cert_file(cert_id), "rb") as file:
+                x509 = crypto.load_certificate(crypto.FILETYPE_PEM, file.read())
+            with open(self.key_file(cert_id), "rb") as file:
+                key = crypto.load_privatekey(crypto.FILETYPE_PEM, file.read())
+        except (OSError, crypto.Error) as err:
+            print("[Certificate Store] Ignoring certificate", cert_id, ":", err.__class__.__name__ + ' -> ' + str(err),
+                  file=sys.stderr)
+            return None
+        if crypto.dump_publickey(crypto.FILETYPE_PEM, x509.get_pubkey()) != \
+                crypto.dump_publickey(crypto.FILETYPE_PEM, key):
+            print("[Certificate Store] Ignoring certificate", cert_id, ": private key doesn't match the certificate",
+                  file=sys.stderr)
+            return None
+
+        names = set()
+        common_name = x509.get_subject().CN
+        if common_name:
+            names.add(common_name.lower())
+        for i in range(x509.get_extension_count()):
+            extension = x509.get_extension(i)
+            if extension.get_short_name() == b"subjectAltName":
+                for entry in str(extension).split(","):
+                    entry = entry.strip()
+                    if entry.startswith("DNS:"):
+                        names.add(entry[4:].lower())
+        not_after = datetime.strptime(x509.get_notAfter().decode(), "%Y%m%d%H%M%SZ")
+        return Certificate(cert_id, not_after, names, state)
+
+    def _add(self, certificate: Certificate):
+        self._remove(certificate.id)
+        self.certificates[certificate.id] = certificate
+        for name in certificate.names:
+            self.names.setdefault(name, set()).add(certificate.id)
+
+    def _remove(self, cert_id: str):
+        certificate = self.certificates.pop(cert_id, None)
+        if certificate is not None:
+            for name in certificate.names:
+                ids = self.names.get(name)
+                if ids is not None:
+                    ids.discard(cert_id)
+                    if not len(ids):
+                        del self.names[name]
+
+    def update(self, cert_id: str):
+        """
+        Read the certificate again, e.g. after the files are written. The certificate is removed if it's not valid.
+        """
+        with self.lock:
+            state = self._state(cert_id)
+            certificate = self._load(cert_id, state) if state is not None else None
+            if certificate is None:
+                self._remove(cert_id)
+            else:
+                self._add(certificate)
+
+    def refresh(self, force=False):
+        """
+        Pick up the certificates that were added, changed or removed since the last refresh.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if not force and self.last_refresh is not None and now - self.last_refresh < self.refresh_interval:
+                return
+            self.last_refresh = now
+            try:
+                present = [x.name[:-4] for x in os.scandir(self.cert_dir) if x.name.endswith(".crt")]
+            except OSError:
+                present = []
+            for cert_id in set(self.certificates.keys()).difference(present):
+                self._remove(cert_id)
+            for cert_id in present:
+                state = self._state(cert_id)
+                known = self.certificates.get(cert_id)
+                if known is not None and known.state == state:
+                    continue
+                certificate = self._load(cert_id, state) if state is not None else None
+                if certificate is None:
+                    self._remove(cert_id)
+                else:
+                    self._add(certificate)
+
+    def get(self, cert_id: str) -> Union[Certificate, None]:
+        with self.lock:
+            return self.certificates.get(cert_id)
+
+    def _best(self, name: str) -> Union[Certificate, None]:
+        best = None
+        for cert_id in self.names.get(name, ()):
+            certificate = self.certificates[cert_id]
+            if not certificate.self_signed and not certificate.companion and (
+                    best is None or certificate.not_after > best.not_after):
+                best = certificate
+        return best
+
+    def find_exact(self, hostname: str) -> Union[Certificate, None]:
+        """
+        :return: the certificate issued for the hostname itself, lasting the longest
+        """
+        with self.lock:
+            return self._best(hostname.lower())
+
+    def find_wildcard(self, hostname: str) -> Union[Certificate, None]:
+        """
+        :return: the wildcard certificate covering the hostname, lasting the longest
+        """
+        labels = hostname.lower().split(".", 1)
+        if len(labels) < 2 or "." not in labels[1]:
+            return None
+        with self.lock:
+            return self._best("*." + labels[1])
+
+    def find_companion(self, certificate: Certificate) -> Union[Certificate, None]:
+        """
+        :return: the RSA certificate to be served along with the given certificate, if there's one
+        """
+        with self.lock:
+            return self.certificates.get(certificate.id + ".rsa")
+
+    def find(self, hostname: str) -> Union[Certificate, None]:
+        return self.find_exact(hostname) or self.find_wildcard(hostname)
+
+    def superseded(self) -> List[Certificate]:
+        """
+        :return: certificates that aren't found for any of their names, because each name has a certificate
+                 lasting longer. Self-signed and companion certificates aren't included.
+        """
+        with self.lock:
+            return [x for x in self.certificates.values() if not x.self_signed and not x.companion
+                    and all(self._best(name) is not x for name in x.names)]
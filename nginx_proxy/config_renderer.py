@@ -0,0 +1,60 @@
+import hashlib
+from typing import Dict, Iterable, List
+
+from jinja2 import Environment, FileSystemLoader
+
+from nginx_proxy.render_view import HostView
+
+
+class ConfigRenderer:
+    """
+    Renders the nginx configuration one server block at a time.
+    The rendered text of each server block is cached by a content hash of the data it is rendered from,
+    so only the server blocks that changed since the last render are rendered again.
+    """
+
+    def __init__(self, template_dir: str, config: dict):
+        self.config = config
+        environment = Environment(loader=FileSystemLoader(template_dir))
+        self.template = environment.get_template("default.conf.jinja2")
+        self.server_template = environment.get_template("server.conf.jinja2")
+        # map the content hash -> rendered server block
+        self.fragments: Dict[str, str] = {}
+        self.rendered_count = 0
+
+    @staticmethod
+    def fingerprint(host: HostView) -> str:
+        """
+        Content hash of everything that affects the rendered server block of the host.
+        """
+        locations = []
+        for location in sorted(host.locations.values(), key=lambda x: x.name):
+            containers = tuple((c.id, c.scheme, c.address, c.port, c.path, c.weight) for c in location.containers)
+            extras = tuple(sorted((k, repr(sorted(v) if type(v) is set else v)) for k, v in location.extras.items()))
+            locations.append((location.name, location.websocket, location.http, location.upstream, location.balance,
+                              location.keepalive, location.keepalive_requests, location.keepalive_timeout,
+                              containers, extras))
+        data = (host.hostname, host.port, host.secured, host.ssl_redirect, host.ssl_files, tuple(locations))
+        return hashlib.sha1(repr(data).encode('utf-8')).hexdigest()
+
+    def render(self, hosts: Iterable[HostView] = ()) -> str:
+        """
+        Render the full configuration for the given hosts, re-rendering only the server blocks not in cache.
+        :return: nginx configuration
+        """
+        fragments: Dict[str, str] = {}
+        blocks: List[str] = []
+        rendered = 0
+        for host in hosts:
+            key = self.fingerprint(host)
+            block = self.fragments.get(key)
+            if block is None:
+                block = self.server_template.render(server=host, config=self.config)
+                rendered += 1
+            fragments[key] = block
+            blocks.append(block)
+
+        # server blocks that no longer exist are dropped from the cache
+        self.fragments = fragments
+        self.rendered_count = rendered
+        return self.template.render(server_blocks=blocks, config=self.config)
@@ -12,13 +12,20 @@ class Container:
         self.path: Union[str, None] = path
         self.scheme: str = scheme
         self.networks = set()  # the list networks through which this container is accessible.
+        self.weight: int = 1  # weight of this container in the upstream of the location
+        self.balance: Union[str, None] = None  # load balancing method requested for the upstream
+        # keepalive options requested for the upstream, None to use the defaults.
+        self.keepalive: Union[int, None] = None
+        self.keepalive_requests: Union[int, None] = None
+        self.keepalive_timeout: Union[str, None] = None
 
     def __repr__(self):
         return str({
             "scheme": self.scheme,
             "address": self.address,
             "port": self.port,
-            "path": self.path
+            "path": self.path,
+            "weight": self.weight
         })
 
     def __hash__(self):
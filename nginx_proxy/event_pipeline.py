@@ -0,0 +1,97 @@
+import queue
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Callable, Union
+
+from nginx_proxy import webserver
+
+
+class EventPipeline:
+    """
+    Processes docker events without blocking the event intake.
+    -- containers are inspected concurrently by a bounded pool of workers, as soon as the event is received.
+    -- state changes are applied one at a time by a single thread, in the order the events were received.
+    -- nginx configuration is applied by the reload scheduler, which merges the resulting reload requests.
+    """
+
+    def __init__(self, server: webserver, workers: int = 4, max_pending: int = 1000):
+        self.server: webserver = server
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="docker-inspect")
+        # bounded, so that event intake slows down instead of piling up inspections when we can't keep up.
+        self.queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self.thread: threading.Thread = threading.Thread(target=self._run, name="event-pipeline", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, event: dict):
+        """
+        Called from the event loop for each docker event. Returns as soon as the event is queued.
+        """
+        inspection: Union[Future, None] = None
+        event_type = event.get('Type')
+        action = event.get('Action')
+        if event_type == "container" and action == "start":
+            inspection = self.executor.submit(self.server.inspect_container, event["id"])
+        elif event_type == "network" and action == "connect":
+            container = event["Actor"]["Attributes"].get("container")
+            if container != self.server.id and event["Actor"]["ID"] in self.server.networks:
+                inspection = self.executor.submit(self.server.inspect_container, container)
+        self.queue.put((event, inspection))
+
+    def submit_task(self, task: Callable[[], Any]):
+        """
+        Run the task on the thread applying the events, after the events received so far.
+        e.g. reconciliation, which shouldn't interleave with processing of an event.
+        """
+        self.queue.put((task, None))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            event, inspection = item
+            try:
+                if callable(event):
+                    event()
+                elif event['Type'] == "network":
+                    self.process_network_event(event['Action'], event, inspection)
+                elif event['Type'] == "container":
+                    self.process_container_event(event['Action'], event, inspection)
+            except (KeyboardInterrupt, SystemExit) as err:
+                raise err
+            except Exception as err:
+                print("Unexpected error :" + err.__class__.__name__ + ' -> ' + str(err), file=sys.stderr)
+                traceback.print_exc(limit=10)
+
+    def process_container_event(self, action, event, inspection: Union[Future, None]):
+        if action == "start":
+            container = inspection.result()
+            if container is not None:
+                self.server.update_container(event["id"], container)
+        elif action == "die":
+            self.server.remove_container(event["id"])
+
+    def process_network_event(self, action, event, inspection: Union[Future, None]):
+        if action == "create":
+            pass
+        elif "container" in event["Actor"]["Attributes"]:
+            attributes = event["Actor"]["Attributes"]
+            if action == "disconnect":
+                self.server.disconnect(network=event["Actor"]["ID"], container=attributes["container"])
+            elif action == "connect":
+                self.server.connect(network=event["Actor"]["ID"], container=attributes["container"],
+                                    inspected=inspection.result() if inspection is not None else None,
+                                    network_name=attributes.get("name"))
+        elif action == "destroy":
+            pass
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
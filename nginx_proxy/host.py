@@ -18,7 +18,8 @@ class Host:
         self.port: int = port
         self.scheme: set = scheme
         self.locations: Dict[str, Location] = {}  # the map of locations.and the container that serve the locations
-        self.container_set: Set[str] = set()
+        # reverse index of container id -> names of the locations served by the container
+        self.container_locations: Dict[str, Set[str]] = {}
         self.secured: bool = 'https' in scheme or 'wss' in scheme
 
     def add_container(self, location: str, container: Container, websocket=False, http=True) -> None:
@@ -28,24 +29,27 @@ class Host:
             self.locations[location].websocket = websocket
             self.locations[location].http = self.locations[location].http or http
         self.locations[location].add(container)
-        self.container_set.add(container.id)
+        if container.id in self.container_locations:
+            self.container_locations[container.id].add(location)
+        else:
+            self.container_locations[container.id] = {location}
 
     def remove_container(self, container_id) -> bool:
-        removed = False
-        deletions = []
-        if container_id in self.container_set:
-            for path, location in self.locations.items():
-                removed = location.remove(container_id) or removed
-                if location.is_empty():
-                    deletions.append(path)
-            for path in deletions:
+        paths = self.container_locations.pop(container_id, None)
+        if paths is None:
+            return False
+        for path in paths:
+            location = self.locations[path]
+            location.remove(container_id)
+            if location.is_empty():
                 del self.locations[path]
-            if removed:
-                self.container_set.remove(container_id)
-        return removed
+        return True
+
+    def has_container(self, container_id) -> bool:
+        return container_id in self.container_locations
 
     def is_empty(self) -> bool:
-        return len(self.container_set) == 0
+        return len(self.container_locations) == 0
 
     def __repr__(self):
         return str({
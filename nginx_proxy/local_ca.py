@@ -0,0 +1,115 @@
+import collections
+import os
+import random
+import sys
+import threading
+from typing import Deque, List
+
+from OpenSSL import crypto
+
+from acme_nginx import keys
+
+
+class KeyPool:
+    """
+    Private keys generated ahead of time by a background thread, so that taking a key doesn't wait for key generation.
+    When the pool runs dry, the key is generated by the caller and the pool is refilled in the background.
+    """
+
+    def __init__(self, key_type: str, size: int = 16):
+        self.key_type = key_type
+        self.size = size
+        self.keys: Deque[crypto.PKey] = collections.deque()
+        self.lock: threading.Condition = threading.Condition()
+        self.thread: threading.Thread = threading.Thread(target=self._run, name="key-pool", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while len(self.keys) >= self.size:
+                    self.lock.wait()
+            key = keys.generate_key(self.key_type)
+            with self.lock:
+                self.keys.append(key)
+
+    def get(self) -> crypto.PKey:
+        with self.lock:
+            if len(self.keys):
+                key = self.keys.popleft()
+                self.lock.notify()
+                return key
+            self.lock.notify()
+        return keys.generate_key(self.key_type)
+
+
+class LocalCA:
+    """
+    Certificate authority of this proxy that signs the fallback certificates used until a certificate is obtained.
+    The CA key and certificate are created once in `<ssl_path>/ca` and reused after restarts,
+    so that the CA certificate can be trusted by clients like a test setup.
+    """
+    name = "nginx-proxy local CA"
+
+    def __init__(self, ssl_path: str, key_type: str, key_pool_size: int = 16):
+        ca_dir = os.path.join(ssl_path, "ca")
+        self.cert_file = os.path.join(ca_dir, "nginx-proxy-ca.crt")
+        self.key_file = os.path.join(ca_dir, "nginx-proxy-ca.key")
+        self.key_pool = KeyPool(key_type, key_pool_size)
+        try:
+            with open(self.cert_file, "rb") as file:
+                self.cert = crypto.load_certificate(crypto.FILETYPE_PEM, file.read())
+            with open(self.key_file, "rb") as file:
+                self.key = crypto.load_privatekey(crypto.FILETYPE_PEM, file.read())
+        except (OSError, crypto.Error) as e:
+            if not isinstance(e, FileNotFoundError):
+                print("[Local CA] Creating new CA :", e.__class__.__name__ + ' -> ' + str(e), file=sys.stderr)
+            os.makedirs(ca_dir, exist_ok=True)
+            self._create(key_type)
+
+    def _create(self, key_type: str):
+        key = keys.generate_key(key_type)
+        cert = crypto.X509()
+        cert.set_version(2)
+        cert.get_subject().O = "Nginx-Proxy - pawanprjl/nginx-proxy"
+        cert.get_subject().CN = self.name
+        cert.set_serial_number(random.SystemRandom().getrandbits(63))
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(20 * 365 * 24 * 60 * 60)
+        cert.set_issuer(cert.get_subject())
+        cert.set_pubkey(key)
+        cert.add_extensions([
+            crypto.X509Extension(b"basicConstraints", True, b"CA:TRUE, pathlen:0"),
+            crypto.X509Extension(b"keyUsage", True, b"keyCertSign, cRLSign"),
+            crypto.X509Extension(b"subjectKeyIdentifier", False, b"hash", subject=cert),
+        ])
+        cert.sign(key, "sha256")
+        with open(self.key_file, "wb") as file:
+            file.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+        os.chmod(self.key_file, 0o400)
+        with open(self.cert_file, "wb") as file:
+            file.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+        self.cert = cert
+        self.key = key
+
+    def issue(self, domains: List[str]) -> (crypto.X509, crypto.PKey):
+        """
+        Sign a certificate for the domains with a key from the key pool.
+        :return: the certificate and its private key
+        """
+        key = self.key_pool.get()
+        cert = crypto.X509()
+        cert.set_version(2)
+        cert.get_subject().O = "Nginx-Proxy - pawanprjl/nginx-proxy"
+        cert.get_subject().CN = domains[0]
+        cert.set_serial_number(random.SystemRandom().getrandbits(63))
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(10 * 365 * 24 * 60 * 60)
+        cert.set_issuer(self.cert.get_subject())
+        cert.set_pubkey(key)
+        cert.add_extensions([
+            crypto.X509Extension(b"basicConstraints", True, b"CA:FALSE"),
+            crypto.X509Extension(b"subjectAltName", False, ", ".join("DNS:" + x for x in domains).encode()),
+        ])
+        cert.sign(self.key, "sha256")
+        return cert, key
@@ -0,0 +1,116 @@
+import heapq
+import random
+import sys
+import threading
+import time
+import traceback
+from datetime import datetime, timedelta
+from typing import Callable, List, Dict, Tuple, Union
+
+
+class RenewalScheduler:
+    """
+    Keeps the certificates in a min-heap ordered by the time they are due for renewal,
+    and renews only the due certificates.
+    -- certificates are due `renew_before` their expiry, plus a jitter so that renewals are spread out.
+       Domains with the same expiry, i.e. issued together, get the same jitter and are renewed together.
+    -- due domains are renewed in batches of up to `batch_size`, with at least `batch_interval` seconds
+       between the batches to respect the rate limits of the acme server.
+    """
+
+    def __init__(self, renew: Callable[[List[str]], None], renew_before=timedelta(days=30), batch_size=50,
+                 batch_interval=60, jitter=timedelta(hours=6)):
+        self.renew = renew
+        self.renew_before: timedelta = renew_before
+        self.batch_size: int = batch_size
+        self.batch_interval: float = batch_interval
+        self.jitter: timedelta = jitter
+        self.lock: threading.Condition = threading.Condition()
+        # heap of (renew_at, domain, expiry). Entries replaced by a later `schedule` call are skipped.
+        self.heap: List[Tuple[datetime, str, datetime]] = []
+        self.entries: Dict[str, Tuple[datetime, datetime]] = {}  # domain -> (renew_at, expiry)
+        self.shutdown_requested: bool = False
+        self.thread: threading.Thread = threading.Thread(target=self._run, name="ssl-renewal")
+
+    def start(self):
+        self.thread.start()
+
+    def renew_time(self, expiry: datetime) -> datetime:
+        jitter = random.Random(int(expiry.timestamp())).uniform(0, self.jitter.total_seconds())
+        return expiry - self.renew_before + timedelta(seconds=jitter)
+
+    def schedule(self, domain: str, expiry: datetime, renew_at: Union[datetime, None] = None):
+        """
+        Schedule renewal of the certificate of the domain, replacing the previously scheduled renewal.
+        Without `renew_at`, a renewal already scheduled for the same expiry is kept, e.g. the delayed retry
+        of a failed renewal. Only a new expiry resets the renewal time.
+        :param renew_at: time to renew at, instead of the time derived from the expiry
+        """
+        with self.lock:
+            if renew_at is None:
+                current = self.entries.get(domain)
+                if current is not None and current[1] == expiry:
+                    return
+                renew_at = self.renew_time(expiry)
+            if self.entries.get(domain) == (renew_at, expiry):
+                return
+            self.entries[domain] = (renew_at, expiry)
+            heapq.heappush(self.heap, (renew_at, domain, expiry))
+            if self.heap[0][1] == domain:
+                self.lock.notify()
+
+    def remove(self, domain: str):
+        with self.lock:
+            self.entries.pop(domain, None)
+
+    def _next_batch(self) -> List[str]:
+        now = datetime.now()
+        batch = []
+        while len(self.heap) and self.heap[0][0] <= now and len(batch) < self.batch_size:
+            renew_at, domain, expiry = heapq.heappop(self.heap)
+            if self.entries.get(domain) != (renew_at, expiry):
+                continue
+            del self.entries[domain]
+            batch.append(domain)
+        return batch
+
+    def _run(self):
+        last_reported = None
+        while True:
+            with self.lock:
+                while not self.shutdown_requested:
+                    while len(self.heap) and self.entries.get(self.heap[0][1]) != (self.heap[0][0], self.heap[0][2]):
+                        heapq.heappop(self.heap)
+                    if not len(self.heap):
+                        self.lock.wait()
+                        continue
+                    delay = (self.heap[0][0] - datetime.now()).total_seconds()
+                    if delay <= 0:
+                        break
+                    if last_reported != self.heap[0]:
+                        last_reported = self.heap[0]
+                        print("[SSL Renewal] Next renewal at", self.heap[0][0], "for", self.heap[0][1],
+                              "- certificate expires at", self.heap[0][2])
+                    # wake up at least hourly, the system clock may change while waiting.
+                    self.lock.wait(min(delay, 3600))
+                if self.shutdown_requested:
+                    return
+                batch = self._next_batch()
+
+            if len(batch):
+                print("[SSL Renewal] Renewing certificates:", batch)
+                try:
+                    self.renew(batch)
+                except Exception as err:
+                    print("[SSL Renewal] Renewal failed :" + err.__class__.__name__ + ' -> ' + str(err),
+                          file=sys.stderr)
+                    traceback.print_exc(limit=10)
+                resume_at = time.monotonic() + self.batch_interval
+                with self.lock:
+                    while not self.shutdown_requested and resume_at > time.monotonic():
+                        self.lock.wait(resume_at - time.monotonic())
+
+    def shutdown(self):
+        with self.lock:
+            self.shutdown_requested = True
+            self.lock.notify()
@@ -1,109 +1,168 @@
+import sys
 import threading
-from datetime import date, datetime
-from typing import List, Set, Dict, Union
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import List, Set, Dict
 
 from nginx.nginx import Nginx
 from nginx_proxy import Host
 from nginx_proxy import webserver
+from nginx_proxy.certificate_store import Certificate
+from nginx_proxy.post_processors.renewal_scheduler import RenewalScheduler
 from nginx_proxy.ssl import SSL
 
 
 class SslCertificateProcessor:
-
-    def __init__(self, nginx: Nginx, server: webserver, start_ssl_thread=False, ssl_dir="/etc/ssl"):
-        self.cache: Dict[str:date] = {}
+    """
+    Chooses the certificate for each secured host during reload.
+    Certificates are never obtained on the reload path: hosts without a valid certificate are served with
+    their existing or a self-signed certificate, while the certificate is issued in the background.
+    Once issued, a follow-up reload swaps in the new certificates.
+    Certificates that are due are renewed by the renewal scheduler, through the same issuance workers.
+    """
+    # time to wait before retrying a domain for which the certificate couldn't be obtained
+    retry_interval = timedelta(minutes=10)
+    # time to wait before retrying a renewal that failed
+    renewal_retry_interval = timedelta(hours=6)
+
+    def __init__(self, nginx: Nginx, server: webserver, start_ssl_thread=False, ssl_dir="/etc/ssl", issue_workers=2,
+                 renew_before_days=30, renew_batch_interval=60, key_type="p256", account_key_type="p256",
+                 dual_certificate=False, key_pool_size=16):
+        self.active: Set[str] = set()  # secured domains in the current configuration
         self.self_signed: Set[str] = set()
-        self.shutdown_requested: bool = False
-        self.lock: threading.Condition = threading.Condition()
+        self.pending: Set[str] = set()  # domains for which certificate is being issued
+        self.failed: Dict[str, datetime] = {}  # domains for which certificate couldn't be obtained -> time of failure
+        self.served: Set[str] = set()  # ids of the certificate files used by the last configuration
+        self.issue_executor = ThreadPoolExecutor(max_workers=issue_workers, thread_name_prefix="ssl-issue")
+        self.lock: threading.Lock = threading.Lock()
         self.nginx: Nginx = nginx
-        self.ssl: SSL = SSL(ssl_dir, nginx)
+        self.ssl: SSL = SSL(ssl_dir, nginx, key_type=key_type, account_key_type=account_key_type,
+                            dual_certificate=dual_certificate, key_pool_size=key_pool_size)
         self.server: webserver = server
-        self.next_ssl_expiry: Union[datetime, None] = None
-        self.certificate_expiry_thread: threading.Thread = threading.Thread(target=self.update_ssl_certificates)
+        self.renewal_scheduler = RenewalScheduler(self.renew_certificates,
+                                                  renew_before=timedelta(days=renew_before_days),
+                                                  batch_interval=renew_batch_interval)
         if start_ssl_thread:
-            self.certificate_expiry_thread.start()
-
-    def process_ssl_certificates(self, hosts: List[Host]):
-        ssl_requests: Set[Host] = set()
-        self.lock.acquire()
-        for host in hosts:
-            if host.secured:
-                if int(host.port) in (80, 443):
-                    host.port = 443
-                    host.ssl_redirect = True
-
-                if host.hostname in self.cache:
-                    host.ssl_file = host.hostname
-                else:
-                    wildcard = self.ssl.wildcard_domain_name(host.hostname)
-                    if wildcard is not None:
-                        if self.ssl.cert_exists(wildcard):
-                            host.ssl_file = wildcard
-                            continue
-
-                    # find the ssl certificate if it exists
-                    time = self.ssl.expiry_time(host.hostname)
-                    if (time - datetime.now()).days > 2:
-                        self.cache[host.hostname] = time
-                        host.ssl_file = host.hostname
+            self.start()
+
+    def start(self):
+        self.renewal_scheduler.start()
+
+    def process_ssl_certificates(self, hosts: List[Host]) -> Dict[str, List[str]]:
+        """
+        Find or obtain the ssl certificates for the secured hosts.
+        :return: map of hostname -> names of the certificate files to be used for the host
+        """
+        ssl_files: Dict[str, List[str]] = {}
+        ssl_requests: Set[str] = set()
+        certificates = self.ssl.certificates
+        certificates.refresh()
+        with self.lock:
+            self.active = set([host.hostname for host in hosts if host.secured])
+            now = datetime.now()
+            for host in hosts:
+                if host.secured:
+                    certificate = certificates.find_exact(host.hostname)
+                    if certificate is not None and (certificate.not_after - now).days > 2:
+                        self.renewal_scheduler.schedule(host.hostname, certificate.not_after)
+                        ssl_files[host.hostname] = self._certificate_files(certificate, now)
+                        continue
+
+                    wildcard = certificates.find_wildcard(host.hostname)
+                    if wildcard is not None and wildcard.not_after > now:
+                        ssl_files[host.hostname] = self._certificate_files(wildcard, now)
+                        continue
+
+                    # keep using the certificate that's about to expire or fall back to self-signed one
+                    # until the new certificate is obtained.
+                    if certificate is not None and certificate.not_after > now:
+                        ssl_files[host.hostname] = self._certificate_files(certificate, now)
                     else:
-                        ssl_requests.add(host)
-
-        if len(ssl_requests):
-            registered = self.ssl.register_certificate_or_self_sign([h.hostname for h in ssl_requests],
-                                                                    ignore_existing=True)
-
-            for host in ssl_requests:
-                if host.hostname not in registered:
-                    host.ssl_file = host.hostname + ".selfsigned"
-                    self.self_signed.add(host.hostname)
+                        ssl_files[host.hostname] = [host.hostname + ".selfsigned"]
+                        if not self.ssl.cert_exists_self_signed(host.hostname):
+                            self.ssl.register_certificate_self_sign(host.hostname)
+                        self.self_signed.add(host.hostname)
+
+                    if host.hostname not in self.pending and (
+                            host.hostname not in self.failed or now - self.failed[host.hostname] > self.retry_interval):
+                        ssl_requests.add(host.hostname)
+
+            # certificates obtained by the proxy that are replaced for all of their names are deleted once
+            # the running configuration doesn't refer to them either. Other certificates are left alone.
+            served = set(x for files in ssl_files.values() for x in files)
+            for certificate in certificates.superseded():
+                if certificate.id not in served and certificate.id not in self.served \
+                        and self.ssl.issued(certificate.id):
+                    print("[SSL] Removing certificate superseded for all of its names:", certificate.id)
+                    self.ssl.remove_certificate(certificate.id)
+            self.served = served
+
+            if len(ssl_requests):
+                self.pending.update(ssl_requests)
+                domains = sorted(ssl_requests)
+                # only fifty at a time
+                for i in range(0, len(domains), 50):
+                    self.issue_executor.submit(self._issue_certificates, domains[i:i + 50])
+
+        return ssl_files
+
+    def _certificate_files(self, certificate: Certificate, now: datetime) -> List[str]:
+        companion = self.ssl.certificates.find_companion(certificate)
+        if companion is not None and companion.not_after > now:
+            return [certificate.id, companion.id]
+        return [certificate.id]
+
+    def _issue_certificates(self, domains: List[str]):
+        """
+        Obtain certificate for the domains and reload once it's obtained. Runs in the issuance workers.
+        """
+        obtained = []
+        try:
+            obtained = self.ssl.obtain_certificate(domains)
+        except (Exception, SystemExit) as err:
+            # acme client exits on unrecoverable errors, which shouldn't bring down the worker.
+            print("[SSL Issue] Failed to obtain certificate for", domains, ":",
+                  err.__class__.__name__ + ' -> ' + str(err), file=sys.stderr)
+            traceback.print_exc(limit=10)
+
+        obtained_set = set(obtained)
+        with self.lock:
+            now = datetime.now()
+            for domain in domains:
+                self.pending.discard(domain)
+                certificate = self.ssl.certificates.find_exact(domain)
+                if domain in obtained_set:
+                    self.self_signed.discard(domain)
+                    self.failed.pop(domain, None)
+                    if certificate is not None:
+                        self.renewal_scheduler.schedule(domain, certificate.not_after)
                 else:
-                    host.ssl_file = host.hostname
-                    self.cache[host.hostname] = self.ssl.expiry_time(host.hostname)
-                    host.ssl_expiry = self.cache[host.hostname]
-
-        if len(self.cache):
-            expiry = min(self.cache.values())
-            if expiry != self.next_ssl_expiry:
-                self.next_ssl_expiry = expiry
-                self.lock.notify()
-
-        self.lock.release()
-
-    def update_ssl_certificates(self):
-        while not self.shutdown_requested:
-            self.lock.acquire()
-            if self.next_ssl_expiry is None:
-                print("[SSL Refresh Thread] No certificates to refresh, waiting for new certificates to be added")
-                self.lock.wait()
-            else:
-                now = datetime.now()
-                remaining_days = (self.next_ssl_expiry - now).days
-
-                if remaining_days > 2:
-                    print("[SSL Refresh Thread] SSL certificate status:")
-
-                    max_size = max([len(x) for x in self.cache])
-                    for host in self.cache:
-                        print('     {host: <{width}} - {remain}'.format(host=host, width=max_size + 2,
-                                                                        remain=self.cache[host] - now))
-                    sleep_time = min(30, remaining_days)
-                    print(
-                        "[SSL Refresh Thread] All the certificates are up to date sleeping for " + str(
-                            sleep_time) + " days.")
-                    self.lock.wait(sleep_time * 3600 * 24 - 10)
-                else:
-                    print("[SSL Refresh Thread] These certificates are about to expire, refreshing them now")
-                    for x in self.cache:
-                        print("Remaining days :", x, ":", (self.cache[x] - now).days)
-
-                    x = [x for x in self.cache if (self.cache[x] - now).days < 6]
-                    for host in x:
-                        del self.cache[host]
-                    self.server.reload()
+                    self.failed[domain] = now
+                    if certificate is not None and certificate.not_after > now:
+                        # renewal failed, the current certificate is still in use.
+                        self.renewal_scheduler.schedule(domain, certificate.not_after,
+                                                        renew_at=now + self.renewal_retry_interval)
+                    else:
+                        # served self-signed, e.g. its DNS record wasn't ready yet. Retried without waiting
+                        # for another reload.
+                        self.renewal_scheduler.schedule(domain, now, renew_at=now + self.retry_interval)
+
+        if len(obtained):
+            print("[SSL Issue] Obtained certificate for", obtained)
+            self.server.schedule_reload()
+
+    def renew_certificates(self, domains: List[str]):
+        """
+        Called by the renewal scheduler with the domains whose certificates are due for renewal.
+        """
+        with self.lock:
+            # domains not served anymore are scheduled again if they come back.
+            domains = [x for x in domains if x in self.active and x not in self.pending]
+            self.pending.update(domains)
+        if len(domains):
+            self.issue_executor.submit(self._issue_certificates, domains)
 
     def shutdown(self):
-        self.lock.acquire()
-        self.shutdown_requested = True
-        self.lock.notify()
-        self.lock.release()
+        self.issue_executor.shutdown(wait=False)
+        self.renewal_scheduler.shutdown()
@@ -1,3 +1,7 @@
+import re
+import sys
+from typing import Dict, Any
+
 from docker.models.containers import Container as DockerContainer
 
 from nginx_proxy import ProxyConfigData, Host
@@ -46,10 +50,17 @@ def host_generator(container: DockerContainer, known_networks: set = {}):
     else:
         raise UnreachableNetwork()
 
+    upstream_options = _parse_upstream_options(env_map)
+
     for host_config in virtual_hosts:
         host, location, container_data, extras = _parse_host_entry(host_config)
         container_data.id = container.id
         container_data.address = ip_address
+        container_data.weight = upstream_options['weight']
+        container_data.balance = upstream_options['balance']
+        container_data.keepalive = upstream_options['keepalive']
+        container_data.keepalive_requests = upstream_options['keepalive_requests']
+        container_data.keepalive_timeout = upstream_options['keepalive_timeout']
         # if port is none, fetch from network settings else set default 80
         if container_data.port is None:
             if len(network_settings["Ports"]) == 1:
@@ -61,6 +72,57 @@ def host_generator(container: DockerContainer, known_networks: set = {}):
         yield host, location, container_data, extras
 
 
+def _parse_int_option(env_map: dict, name: str, minimum: int):
+    if name in env_map:
+        try:
+            value = int(env_map[name])
+            if value >= minimum:
+                return value
+        except ValueError:
+            pass
+        print("[WARNING] Ignoring invalid " + name + ":", env_map[name], file=sys.stderr)
+    return None
+
+
+def _parse_upstream_options(env_map: dict) -> Dict[str, Any]:
+    """
+    Read the upstream options of the container.
+    UPSTREAM_WEIGHT -> weight of the container among the containers serving the same location
+    UPSTREAM_BALANCE -> round_robin (default), least_conn, ip_hash or hash <key> [consistent]
+    UPSTREAM_KEEPALIVE -> idle keepalive connections to the backend kept per worker, 0 to disable
+    UPSTREAM_KEEPALIVE_REQUESTS -> requests served through a single keepalive connection
+    UPSTREAM_KEEPALIVE_TIMEOUT -> idle timeout of the keepalive connections e.g. 60s
+    Options that are not set are None, so that the proxy defaults are used.
+    """
+    weight = _parse_int_option(env_map, "UPSTREAM_WEIGHT", 1)
+
+    balance = env_map.get("UPSTREAM_BALANCE", "").strip() or None
+    if balance is not None:
+        method = balance.split()[0]
+        if method in ("round_robin", "round-robin"):
+            balance = None
+        elif method in ("least_conn", "ip_hash"):
+            balance = method
+        elif method == "hash" and len(balance.split()) > 1:
+            balance = " ".join(balance.split())
+        else:
+            print("[WARNING] Ignoring invalid UPSTREAM_BALANCE:", balance, file=sys.stderr)
+            balance = None
+
+    keepalive_timeout = env_map.get("UPSTREAM_KEEPALIVE_TIMEOUT")
+    if keepalive_timeout is not None and not re.match(r"^[0-9]+(ms|s|m|h|d)?$", keepalive_timeout):
+        print("[WARNING] Ignoring invalid UPSTREAM_KEEPALIVE_TIMEOUT:", keepalive_timeout, file=sys.stderr)
+        keepalive_timeout = None
+
+    return {
+        'weight': weight if weight is not None else 1,
+        'balance': balance,
+        'keepalive': _parse_int_option(env_map, "UPSTREAM_KEEPALIVE", 0),
+        'keepalive_requests': _parse_int_option(env_map, "UPSTREAM_KEEPALIVE_REQUESTS", 1),
+        'keepalive_timeout': keepalive_timeout,
+    }
+
+
 def _parse_host_entry(entry_string: str) -> (Host, str):
     configs = entry_string.split(";", 1)
     extras = set()
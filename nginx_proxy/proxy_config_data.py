@@ -1,4 +1,4 @@
-from typing import Set, Dict, Generator, Tuple
+from typing import Set, Dict, Generator, Tuple, KeysView
 
 from nginx_proxy.host import Host
 
@@ -12,12 +12,25 @@ class ProxyConfigData:
     def __init__(self):
         # map the hostname -> port -> host_configuration
         self.config_map: Dict[str, Dict[int, Host]] = {}
-        self.containers: Set[str] = set()
+        # reverse index of container id -> (hostname, port) of the hosts served by the container.
+        # each host further indexes the locations served by the container.
+        self.container_index: Dict[str, Set[Tuple[str, int]]] = {}
         self._len = 0
 
     def __len__(self):
         return self._len
 
+    @property
+    def containers(self) -> KeysView[str]:
+        return self.container_index.keys()
+
+    def _index(self, container_id: str, host: Host) -> None:
+        key = (host.hostname, host.port)
+        if container_id in self.container_index:
+            self.container_index[container_id].add(key)
+        else:
+            self.container_index[container_id] = {key}
+
     def add_host(self, host: Host) -> None:
         if host.hostname in self.config_map:
             port_map = self.config_map[host.hostname]
@@ -27,7 +40,7 @@ class ProxyConfigData:
                 for location in host.locations.values():
                     for container in location.containers:
                         existing_host.add_container(location.name, container, location.websocket, location.http)
-                        self.containers.add(container.id)
+                        self._index(container.id, existing_host)
                     existing_host.locations[location.name].update_extras(location.extras)
                 return
             else:
@@ -38,25 +51,33 @@ class ProxyConfigData:
             self._len = self._len + 1
             self.config_map[host.hostname] = {host.port: host}
 
-        for location in host.locations.values():
-            for container in location.containers:
-                self.containers.add(container.id)
+        for container_id in host.container_locations:
+            self._index(container_id, host)
 
-    def remove_container(self, container_id: str) -> Tuple[bool, Set[Tuple[str, int]]]:
-        removed_domains = set()
-        result = False
-        if container_id in self.containers:
-            self.containers.remove(container_id)
-            for host in self.host_list():
-                if host.remove_container(container_id):
-                    result = True
-                    if host.is_empty():
-                        removed_domains.add((host.hostname, host.port))
-
-        return result, removed_domains
+    def remove_container(self, container_id: str) -> Set[Tuple[str, int]]:
+        """
+        Remove the container from all the hosts it serves. Hosts left without any container are removed.
+        :return: (hostname, port) of the server blocks affected by the removal.
+        """
+        dirty = self.container_index.pop(container_id, set())
+        for hostname, port in dirty:
+            port_map = self.config_map[hostname]
+            host = port_map[port]
+            host.remove_container(container_id)
+            if host.is_empty():
+                self._len = self._len - 1
+                del port_map[port]
+                if not len(port_map):
+                    del self.config_map[hostname]
+        return dirty
 
     def has_container(self, container_id):
-        return container_id in self.containers
+        return container_id in self.container_index
+
+    def clear(self):
+        self.config_map = {}
+        self.container_index = {}
+        self._len = 0
 
     def host_list(self) -> Generator[Host, None, None]:
         for host_map in self.config_map.values():
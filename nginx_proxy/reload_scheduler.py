@@ -0,0 +1,77 @@
+import sys
+import threading
+import time
+import traceback
+from typing import Callable, Union
+
+
+class ReloadScheduler:
+    """
+    Sits between the docker event handlers and the actual nginx reload.
+    Reload requests that arrive close to each other are merged, so that a burst of events
+    (e.g. `docker compose up` with hundreds of services) results in a single render and a single reload.
+
+    A reload is performed once no new request has arrived for `quiet_period` seconds,
+    or when `max_delay` seconds have passed since the first pending request, whichever comes first.
+    """
+
+    def __init__(self, reload: Callable[[], bool], quiet_period: float = 0.5, max_delay: float = 5.0):
+        self.reload = reload
+        self.quiet_period: float = quiet_period
+        self.max_delay: float = max(max_delay, quiet_period)
+        self.lock: threading.Condition = threading.Condition()
+        self.pending_events: int = 0
+        self.first_request: Union[float, None] = None
+        self.last_request: Union[float, None] = None
+        self.shutdown_requested: bool = False
+        self.thread: threading.Thread = threading.Thread(target=self._run, name="reload-scheduler")
+
+    def start(self):
+        self.thread.start()
+
+    def schedule(self):
+        """
+        Request a reload. The reload is not performed immediately but once the current burst of changes settles.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.pending_events == 0:
+                self.first_request = now
+            self.last_request = now
+            self.pending_events += 1
+            self.lock.notify()
+
+    def _next_deadline(self) -> float:
+        return min(self.last_request + self.quiet_period, self.first_request + self.max_delay)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                while not self.shutdown_requested and self.pending_events == 0:
+                    self.lock.wait()
+                if self.shutdown_requested:
+                    return
+                remaining = self._next_deadline() - time.monotonic()
+                if remaining > 0:
+                    self.lock.wait(remaining)
+                    continue
+                merged = self.pending_events
+                waited = time.monotonic() - self.first_request
+                self.pending_events = 0
+                self.first_request = None
+                self.last_request = None
+
+            start = time.monotonic()
+            try:
+                self.reload()
+            except Exception as err:
+                print("[Reload Scheduler] Reload failed :" + err.__class__.__name__ + ' -> ' + str(err),
+                      file=sys.stderr)
+                traceback.print_exc(limit=10)
+            print("[Reload Scheduler] Merged %d event(s) into a single reload (waited %.3fs, took %.3fs)"
+                  % (merged, waited, time.monotonic() - start))
+
+    def shutdown(self):
+        with self.lock:
+            self.shutdown_requested = True
+            self.lock.notify()
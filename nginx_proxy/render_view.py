@@ -0,0 +1,120 @@
+import hashlib
+import re
+from typing import Dict, Union, List, Any
+
+from nginx_proxy.host import Host
+from nginx_proxy.location import Location
+
+
+class _ReadOnly:
+    __slots__ = ()
+
+    def __setattr__(self, key, value):
+        raise AttributeError("'%s' is read-only" % self.__class__.__name__)
+
+    def __delattr__(self, key):
+        raise AttributeError("'%s' is read-only" % self.__class__.__name__)
+
+
+def upstream_name(hostname: str, port: int, location: str) -> str:
+    """
+    Unique name of the upstream block of a location. It's also a valid hostname,
+    as nginx sends it in the Host header to the backend unless the header is overridden.
+    """
+    parts = [re.sub(r"[^A-Za-z0-9.-]+", "-", x).strip("-.") for x in (hostname, str(port), location)]
+    digest = hashlib.sha1(("%s:%d%s" % (hostname, port, location)).encode("utf-8")).hexdigest()[:6]
+    return "-".join([x for x in parts if x] + [digest])
+
+
+class LocationView(_ReadOnly):
+    """
+    Read-only view of a Location, along with the upstream the location is proxied to.
+    `containers` are ordered so that the upstream block renders the same for the same set of containers.
+    `container` is the container whose scheme and path are used in proxy_pass.
+    Upstream options not set by any of the containers fall back to the `upstream_*` values of the config.
+    """
+    __slots__ = ('_location', 'upstream', 'containers', 'container', 'balance',
+                 'keepalive', 'keepalive_requests', 'keepalive_timeout')
+
+    def __init__(self, location: Location, upstream: str, config: Dict[str, Any]):
+        containers = sorted(location.containers, key=lambda c: c.id)
+
+        def option(name):
+            value = next((getattr(c, name) for c in containers if getattr(c, name) is not None), None)
+            return value if value is not None else config.get('upstream_' + name)
+
+        object.__setattr__(self, '_location', location)
+        object.__setattr__(self, 'upstream', upstream)
+        object.__setattr__(self, 'containers', containers)
+        object.__setattr__(self, 'container', containers[0])
+        object.__setattr__(self, 'balance', option('balance'))
+        object.__setattr__(self, 'keepalive', option('keepalive'))
+        object.__setattr__(self, 'keepalive_requests', option('keepalive_requests'))
+        object.__setattr__(self, 'keepalive_timeout', option('keepalive_timeout'))
+
+    @property
+    def name(self) -> str:
+        return self._location.name
+
+    @property
+    def http(self) -> bool:
+        return self._location.http
+
+    @property
+    def websocket(self) -> bool:
+        return self._location.websocket
+
+    @property
+    def extras(self) -> Dict[str, Any]:
+        return self._location.extras
+
+    def __repr__(self):
+        return repr(self._location)
+
+
+class HostView(_ReadOnly):
+    """
+    Read-only view of a stored Host, carrying the fields derived for rendering the server block.
+    The stored Host is never modified or copied during reload.
+    """
+    __slots__ = ('_host', 'port', 'ssl_redirect', 'ssl_files', 'locations')
+
+    def __init__(self, host: Host, ssl_files: Union[List[str], None] = None,
+                 config: Union[Dict[str, Any], None] = None):
+        if config is None:
+            config = {}
+        port = host.port
+        ssl_redirect = False
+        if host.secured and int(port) in (80, 443):
+            port = 443
+            ssl_redirect = True
+        object.__setattr__(self, '_host', host)
+        object.__setattr__(self, 'port', port)
+        object.__setattr__(self, 'ssl_redirect', ssl_redirect)
+        # names of the certificate files, e.g. ECDSA and RSA certificate of the host
+        object.__setattr__(self, 'ssl_files', tuple(ssl_files) if ssl_files else ())
+        object.__setattr__(self, 'locations', {
+            name: LocationView(location, upstream_name(host.hostname, host.port, name), config)
+            for name, location in host.locations.items()
+        })
+
+    @property
+    def hostname(self) -> str:
+        return self._host.hostname
+
+    @property
+    def scheme(self) -> set:
+        return self._host.scheme
+
+    @property
+    def secured(self) -> bool:
+        return self._host.secured
+
+    def __repr__(self):
+        return str({
+            "scheme": self.scheme,
+            "server_name": self.hostname,
+            "port": self.port,
+            "ssl_files": self.ssl_files,
+            "locations": self.locations
+        })
@@ -1,14 +1,16 @@
+import hashlib
 import logging
 import os
-import shutil
-from datetime import datetime
+import sys
 from os.path import join
 
-import OpenSSL
+import requests
 from OpenSSL import crypto
 
 from acme_nginx.AcmeV2 import AcmeV2
 from nginx.nginx import Nginx
+from nginx_proxy.certificate_store import CertificateStore
+from nginx_proxy.local_ca import LocalCA
 
 
 def get_api_url():
@@ -25,11 +27,23 @@ def get_api_url():
 # used acme_nginx to manage ssl certificates from https://github.com/kshcherban/acme-nginx
 class SSL:
 
-    def __init__(self, ssl_path, nginx: Nginx):
+    def __init__(self, ssl_path, nginx: Nginx, key_type="p256", account_key_type="p256", dual_certificate=False,
+                 key_pool_size=16):
         self.ssl_path = ssl_path
         self.nginx = nginx
         self.api_url = get_api_url()
         print("Using letsencrypt url: ", self.api_url)
+        # key types of the new keys. Existing keys are reused on renewal.
+        self.key_type = key_type
+        self.account_key_type = account_key_type
+        # also obtain an RSA certificate for the clients that don't support ECDSA
+        self.dual_certificate = dual_certificate and not key_type.startswith("rsa")
+        # keep-alive connection to the acme server shared by all the certificate requests.
+        self.acme_http = requests.Session()
+        ca_bundle = os.environ.get("LETSENCRYPT_CA_BUNDLE")
+        if ca_bundle:
+            # e.g. the root certificate of a local test CA like pebble
+            self.acme_http.verify = ca_bundle
 
         try:
             os.mkdir(os.path.join(ssl_path, "accounts"))
@@ -37,6 +51,9 @@ class SSL:
             os.mkdir(os.path.join(ssl_path, "certs"))
         except FileExistsError as e:
             pass
+        self.certificates = CertificateStore(ssl_path)
+        # signs the self-signed fallback certificates, with keys generated in the background
+        self.local_ca = LocalCA(ssl_path, self.key_type, key_pool_size=key_pool_size)
 
     def cert_file(self, domain):
         return os.path.join(self.ssl_path, "certs", domain + ".crt")
@@ -44,9 +61,6 @@ class SSL:
     def private_file(self, domain):
         return os.path.join(self.ssl_path, "private", domain + ".key")
 
-    def selfsigned_cert_file(self, domain):
-        return os.path.join(self.ssl_path, "certs", domain + ".selfsigned.cert")
-
     def selfsigned_private_file(self, domain):
         return os.path.join(self.ssl_path, "private", domain + "selfsgned.key")
 
@@ -54,55 +68,103 @@ class SSL:
         CERT_FILE = domain + ".selfsigned.crt"
         KEY_FILE = domain + ".selfsigned.key"
 
-        k = crypto.PKey()
-        k.generate_key(crypto.TYPE_RSA, 1024)
-
-        # create a self-signed cert
-        cert = crypto.X509()
-        cert.get_subject().C = "US"
-        cert.get_subject().ST = "Subject_st"
-        cert.get_subject().L = "Subject_l"
-        cert.get_subject().O = "Nginx-Proxy - pawanprjl/nginx-proxy"
-        # cert.get_subject().OU = "my organization"
-        cert.get_subject().CN = domain
-        cert.set_serial_number(1000)
-        cert.gmtime_adj_notBefore(0)
-        cert.gmtime_adj_notAfter(10 * 365 * 24 * 60 * 60)
-        cert.set_issuer(cert.get_subject())
-        cert.set_pubkey(k)
-        cert.sign(k, 'sha256')
+        cert, k = self.local_ca.issue([domain])
 
         open(join(self.ssl_path, "certs", CERT_FILE), "wb").write(
             crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
         open(join(self.ssl_path, "private", KEY_FILE), "wb").write(
             crypto.dump_privatekey(crypto.FILETYPE_PEM, k))
-
-    def expiry_time(self, domain) -> datetime:
-        if self.cert_exists(domain):
-            with open(self.cert_file(domain)) as file:
-                x509 = OpenSSL.crypto.load_certificate(OpenSSL.crypto.FILETYPE_PEM, file.read())
-                return datetime.strptime(x509.get_notAfter().decode(), "%Y%m%d%H%M%SZ")
-        return datetime.now()
+        self.certificates.update(domain + ".selfsigned")
 
     def cert_exists(self, domain):
-        return os.path.exists(self.cert_file(domain)) and os.path.exists(self.private_file(domain))
-
-    def wildcard_domain_name(self, domain):
-        slices = domain.split('.')
-        if len(slices) > 2:
-            return '*.' + ('.'.join(slices[1:len(slices)]))
-        return None
+        return self.certificates.find_exact(domain) is not None
 
     def cert_exists_self_signed(self, domain) -> bool:
-        return self.cert_exists((domain + ".selfsigned"))
-
-    def reuse(self, domain1, domain2):
-        shutil.copy2(os.path.join(self.ssl_path, "certs", domain1 + ".crt"),
-                     os.path.join(self.ssl_path, "certs", domain2 + ".crt"))
-        shutil.copy2(os.path.join(self.ssl_path, "private", domain1 + ".key"),
-                     os.path.join(self.ssl_path, "private", domain2 + ".key"))
-        shutil.copy2(os.path.join(self.ssl_path, "accounts", domain1 + ".account.key"),
-                     os.path.join(self.ssl_path, "accounts", domain2 + ".account.key"))
+        return self.certificates.get(domain + ".selfsigned") is not None
+
+    def account_key_file(self, domains: list) -> str:
+        """
+        Account key used to request certificate for the domains. When renewing, it's the key of the account
+        that requested the current certificate, so that a new account isn't created for each renewal.
+        """
+        for domain in domains:
+            certificate = self.certificates.find_exact(domain)
+            for name in ([domain, certificate.id] if certificate is not None else [domain]):
+                key_file = os.path.join(self.ssl_path, "accounts", name + ".account.key")
+                if os.path.exists(key_file):
+                    return key_file
+        return os.path.join(self.ssl_path, "accounts", domains[0] + ".account.key")
+
+    def certificate_id(self, domains: list) -> str:
+        """
+        Name to save the certificate for the domains as. It's the first domain, unless the certificate saved
+        with that name has names that aren't among the domains, e.g. a certificate shared by domains of which
+        only some are being renewed. That certificate is still in use by the other domains, so the new one is
+        saved with a suffix derived from the domains instead.
+        """
+        existing = self.certificates.get(domains[0])
+        if existing is None or existing.names.issubset(x.lower() for x in domains):
+            return domains[0]
+        return domains[0] + "." + hashlib.sha1(",".join(sorted(x.lower() for x in domains)).encode()).hexdigest()[:8]
+
+    def _account_link(self, cert_id) -> str:
+        return os.path.join(self.ssl_path, "accounts", cert_id + ".account.key")
+
+    def _record_issued(self, cert_id, account_key):
+        """
+        Link `accounts/<cert_id>.account.key` to the account key the certificate was requested with.
+        It marks the certificate as issued by the proxy, and is where its renewal finds the account key.
+        """
+        link = self._account_link(cert_id)
+        if not os.path.lexists(link) and os.path.exists(account_key):
+            os.symlink(os.path.basename(account_key), link)
+
+    def issued(self, cert_id) -> bool:
+        """
+        Whether the certificate was obtained by the proxy, as opposed to e.g. one put in place by the operator.
+        """
+        return os.path.exists(self._account_link(cert_id))
+
+    def remove_certificate(self, cert_id):
+        """
+        Delete the certificate, its private key and its companion RSA certificate.
+        """
+        for name in (cert_id, cert_id + ".rsa"):
+            for file_path in (self.certificates.cert_file(name), self.certificates.key_file(name)):
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+            self.certificates.update(name)
+        # the account key itself is kept, it may be used by other certificates.
+        if os.path.islink(self._account_link(cert_id)):
+            os.remove(self._account_link(cert_id))
+
+    def _obtain(self, domain: list, cert_id, key_type) -> bool:
+        """
+        Obtain a certificate for the domains, saved as `cert_id` with a private key of the given type.
+        """
+        acme = AcmeV2(
+            self.nginx,
+            api_url=self.api_url,
+            logger=logging.getLogger("acme"),
+            domains=domain,
+            account_key=self.account_key_file(domain),
+            domain_key=os.path.join(self.ssl_path, "private", cert_id + ".key"),
+            cert_path=os.path.join(self.ssl_path, "certs", cert_id + ".crt"),
+            debug=False,
+            dns_provider=None,
+            # the certificate is put to use by a reload after it's obtained
+            skip_nginx_reload=True,
+            challenge_dir=self.nginx.challenge_dir,
+            http=self.acme_http,
+            account_key_type=self.account_key_type,
+            domain_key_type=key_type
+        )
+        directory = acme.register_account()
+        obtained = acme.solve_http_challenge(directory)
+        self.certificates.update(cert_id)
+        return obtained
 
     def register_certificate(self, domain, no_self_check=False, ignore_existing=False):
         if type(domain) is str:
@@ -113,45 +175,32 @@ class SSL:
         domain = verified_domain if ignore_existing else [x for x in verified_domain if not self.cert_exists(x)]
         if len(domain):
             logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.DEBUG)
-            acme = AcmeV2(
-                self.nginx,
-                api_url=self.api_url,
-                logger=logging.getLogger("acme"),
-                domains=domain,
-                account_key=os.path.join(self.ssl_path, "accounts", domain[0] + ".account.key"),
-                domain_key=os.path.join(self.ssl_path, "private", domain[0] + ".key"),
-                cert_path=os.path.join(self.ssl_path, "certs", domain[0] + ".crt"),
-                debug=False,
-                dns_provider=None,
-                skip_nginx_reload=False,
-                challenge_dir=self.nginx.challenge_dir
-            )
-            directory = acme.register_account()
-            return domain if acme.solve_http_challenge(directory) else []
+            cert_id = self.certificate_id(domain)
+            # resolved before the new certificate is indexed, which changes the lookup
+            account_key = self.account_key_file(domain)
+            obtained = self._obtain(domain, cert_id, self.key_type)
+            if obtained:
+                self._record_issued(cert_id, account_key)
+            if obtained and self.dual_certificate:
+                # the authorizations are already valid, so it's just another order.
+                try:
+                    self._obtain(domain, cert_id + ".rsa", "rsa2048")
+                except (Exception, SystemExit) as e:
+                    # the ECDSA certificate is served alone
+                    print("[SSL-Register] Failed to obtain RSA certificate for", domain, ":",
+                          e.__class__.__name__ + ' -> ' + str(e), file=sys.stderr)
+            return domain if obtained else []
         else:
             print("[SSL-Register] the files already so ignored: " + str(domain))
             return verified_domain
 
-    def register_certificate_or_self_sign(self, domain, no_self_check=False, ignore_existing=False):
-        print("[CertificateOrSelfSign] Adding domains:", domain)
-        obtained_certificates = []
-
-        for i in range(0, len(domain), 50):
-            # only fifty at a time
-            sub_list = domain[i:i + 50]
-            obtained = self.register_certificate(sub_list, no_self_check=no_self_check, ignore_existing=ignore_existing)
-            if len(obtained):
-                domain1 = obtained[0]
-                for x in obtained[1:]:
-                    self.reuse(domain1, x)
-                obtained_certificates.extend(obtained)
-
-        obtained_set = set(obtained_certificates)
-        self_signed = [x for x in domain if x not in obtained_set]
-        if len(self_signed):
-            print("[Self Signing Certificates]", self_signed)
-        self.register_certificate_self_sign(self_signed)
-        return obtained_certificates
+    def obtain_certificate(self, domain: list, no_self_check=False, ignore_existing=True) -> list:
+        """
+        Obtain a single certificate for up to fifty domains. The certificate is saved once, named after the
+        first domain (see `certificate_id`), and found for the other domains through its subject alternative names.
+        :return: the domains for which the certificate was obtained
+        """
+        return self.register_certificate(domain, no_self_check=no_self_check, ignore_existing=ignore_existing)
 
     def register_certificate_self_sign(self, domains):
         if type(domains) is str:
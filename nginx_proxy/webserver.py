@@ -1,51 +1,123 @@
-import copy
 import os
 import sys
-from typing import List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, FrozenSet, List, Tuple, Union
 
 import requests
 from docker import DockerClient
 from docker.models.containers import Container as DockerContainer
-from jinja2 import Template
 
+from acme_nginx import keys
 from nginx.nginx import Nginx
 from nginx_proxy import ProxyConfigData, pre_processors, Host, post_processors
+from nginx_proxy.config_renderer import ConfigRenderer
+from nginx_proxy.event_pipeline import EventPipeline
+from nginx_proxy.reload_scheduler import ReloadScheduler
+from nginx_proxy.render_view import HostView
 
 
 def strip_end(string: str, char="/"):
     return string[:-1] if string.endswith(char) else string
 
 
+def env_value(name: str, default: str, parse):
+    value = os.getenv(name, default)
+    try:
+        return parse(value)
+    except ValueError:
+        raise ValueError("Invalid value for environment variable %s: %r" % (name, value)) from None
+
+
+def env_int(name: str, default: str) -> int:
+    return env_value(name, default, int)
+
+
+def env_float(name: str, default: str) -> float:
+    return env_value(name, default, float)
+
+
+def env_key_type(name: str, default: str) -> str:
+    if not os.getenv(name):
+        return default
+    return env_value(name, default, keys.parse_key_type)
+
+
 def loadconfig():
     return {
         'config_dir': strip_end(os.getenv('NGINX_CONFIG_DIR', '/etc/nginx/')),
         'ssl_dir': strip_end(os.getenv('SSL_DIR', '/etc/ssl/')),
         'challenge_dir': os.getenv('CHALLENGE_DIR', '/tmp/acme-challenges/'),
         'client_max_body_size': os.getenv('CLIENT_MAX_BODY_SIZE', '1m'),
+        'upstream_keepalive': env_int('UPSTREAM_KEEPALIVE', '32'),
+        'upstream_keepalive_requests': env_int('UPSTREAM_KEEPALIVE_REQUESTS', '1000'),
+        'upstream_keepalive_timeout': os.getenv('UPSTREAM_KEEPALIVE_TIMEOUT', '60s'),
+        'ssl_issue_workers': env_int('SSL_ISSUE_WORKERS', '2'),
+        # key types of the new keys. Existing keys are reused on renewal.
+        'ssl_key_type': env_key_type('SSL_KEY_TYPE', 'p256'),
+        'ssl_account_key_type': env_key_type('SSL_ACCOUNT_KEY_TYPE', 'p256'),
+        'ssl_dual_certificate': os.getenv('SSL_DUAL_CERTIFICATE', 'false').strip().lower() == 'true',
+        'ssl_key_pool_size': env_int('SSL_KEY_POOL_SIZE', '16'),
+        'ssl_renew_before_days': env_int('SSL_RENEW_BEFORE_DAYS', '30'),
+        'ssl_renew_batch_interval': env_int('SSL_RENEW_BATCH_INTERVAL', '60'),
+        'event_workers': env_int('EVENT_WORKERS', '4'),
+        'scan_workers': env_int('SCAN_WORKERS', '16'),
+        # only the containers with this label are proxied, e.g. `proxy.enable` or `proxy.enable=true`
+        'proxy_label': os.getenv('PROXY_LABEL', '').strip() or None,
+        'reconcile_interval': env_float('RECONCILE_INTERVAL', '300'),
+        'reload_quiet_period': env_float('RELOAD_QUIET_PERIOD', '0.5'),
+        'reload_max_delay': env_float('RELOAD_MAX_DELAY', '5'),
+        'max_draining_generations': env_int('MAX_DRAINING_GENERATIONS', '3'),
+        'drain_wait': env_float('DRAIN_WAIT', '30'),
+        'nginx_ready_timeout': env_float('NGINX_READY_TIMEOUT', '30'),
+        'config_versions': env_int('CONFIG_VERSIONS', '10'),
     }
 
 
 class WebServer:
 
     def __init__(self, client: DockerClient):
+        # (phase, time it ended) of the startup, to spot slow cold starts
+        self.startup_phases: List[Tuple[str, float]] = [("", time.monotonic())]
         self.id = None
         self.container = None
         self.client = client
         self.config = loadconfig()
         self.conf_file_name = self.config['config_dir'] + "/conf.d/default.conf"
-        self.nginx = Nginx(self.conf_file_name)
+        self.nginx = Nginx(self.conf_file_name, max_draining_generations=self.config['max_draining_generations'],
+                           drain_wait=self.config['drain_wait'], config_versions=self.config['config_versions'])
         self.config_data = ProxyConfigData()
         self.networks = {}
-        file = open("vhosts_template/default.conf.jinja2")
-        self.template = Template(file.read())
-        file.close()
+        # networks of the inspected containers at the time of inspection: container id -> {(network id, ip)}
+        self.inspected: Dict[str, FrozenSet[Tuple[str, str]]] = {}
+        # start of the initial scan. Events are watched since then, so that no change is missed in between.
+        self.scan_time = None
+        self.shutdown_requested = threading.Event()
+        self.reconcile_thread = threading.Thread(target=self._reconcile_periodically, name="reconcile", daemon=True)
+        # guards config_data, which is mutated by the event loop and read by the reload scheduler thread.
+        self.lock = threading.RLock()
+        self.reload_scheduler = ReloadScheduler(self.reload,
+                                                quiet_period=self.config['reload_quiet_period'],
+                                                max_delay=self.config['reload_max_delay'])
+        self.event_pipeline = EventPipeline(self, workers=self.config['event_workers'])
+        self.renderer = ConfigRenderer("vhosts_template", self.config)
         self.learn_yourself()
-        self.ssl_processor = post_processors.SslCertificateProcessor(self.nginx, self, ssl_dir=self.config['ssl_dir'])
+        self.ssl_processor = post_processors.SslCertificateProcessor(
+            self.nginx, self, ssl_dir=self.config['ssl_dir'],
+            issue_workers=self.config['ssl_issue_workers'],
+            key_type=self.config['ssl_key_type'],
+            account_key_type=self.config['ssl_account_key_type'],
+            dual_certificate=self.config['ssl_dual_certificate'],
+            key_pool_size=self.config['ssl_key_pool_size'],
+            renew_before_days=self.config['ssl_renew_before_days'],
+            renew_batch_interval=self.config['ssl_renew_batch_interval'])
+        self._startup_phase("setup")
 
         if self.nginx.config_test():
             if len(self.nginx.last_working_config) < 50:
                 print("Writing default config before reloading server.")
-                if not self.nginx.force_start(self.template.render(config=self.config)):
+                if not self.nginx.force_start(self.renderer.render()):
                     print("Nginx failed when reloaded with default config", file=sys.stderr)
                     print("Exiting .....", file=sys.stderr)
                     exit(1)
@@ -56,16 +128,33 @@ class WebServer:
         else:
             print("ERROR: Existing nginx configuration has error, trying to override with default configuration",
                   file=sys.stderr)
-            if not self.nginx.force_start(self.template.render(config=self.config)):
+            if not self.nginx.force_start(self.renderer.render()):
                 print("Nginx failed when reloaded with default config", file=sys.stderr)
                 print("Exiting .....", file=sys.stderr)
                 exit(1)
+        self._startup_phase("nginx start")
 
-        self.nginx.wait()
+        if not self.nginx.wait(timeout=self.config['nginx_ready_timeout']):
+            print("Nginx failed to become ready", file=sys.stderr)
+            print("Exiting .....", file=sys.stderr)
+            exit(1)
+        self._startup_phase("nginx ready")
 
+        self.scan_time = time.time()
         self.rescan_all_container()
+        self._startup_phase("container scan")
         self.reload()
-        self.ssl_processor.certificate_expiry_thread.start()
+        self._startup_phase("initial reload")
+        self.reload_scheduler.start()
+        self.event_pipeline.start()
+        self.ssl_processor.start()
+        self.reconcile_thread.start()
+        print("[Startup] " + ", ".join("%s: %.0f ms" % (name, (end - self.startup_phases[i][1]) * 1000)
+                                       for i, (name, end) in enumerate(self.startup_phases[1:])) +
+              " -> total: %.0f ms" % ((self.startup_phases[-1][1] - self.startup_phases[0][1]) * 1000))
+
+    def _startup_phase(self, name: str):
+        self.startup_phases.append((name, time.monotonic()))
 
     def learn_yourself(self):
         """
@@ -80,8 +169,8 @@ class WebServer:
                 raise Exception("HOSTNAME environment variable not set")
             self.container = self.client.containers.get(hostname)
             self.id = self.container.id
-            self.networks = {self.client.networks.get(a).id: a
-                             for a in self.container.attrs["NetworkSettings"]["Networks"].keys()}
+            self.networks = {detail["NetworkID"]: name
+                             for name, detail in self.container.attrs["NetworkSettings"]["Networks"].items()}
         except (KeyboardInterrupt, SystemExit) as err:
             raise err
         except Exception as err:
@@ -97,46 +186,64 @@ class WebServer:
         If it's not configured with desired settings or is not accessible, return False
         :return: True if the container is added to virtual hosts, false otherwise.
         """
+        with self.lock:
+            self.inspected[container.id] = self._network_state(container.attrs)
+        if not self.has_proxy_label(container):
+            return False
         known_networks = set(self.networks.keys())
         hosts = pre_processors.process_virtual_hosts(container, known_networks)
         if len(hosts):
             hosts.print()
-            for h in hosts.host_list():
-                self.config_data.add_host(h)
+            with self.lock:
+                for h in hosts.host_list():
+                    self.config_data.add_host(h)
         return len(hosts) > 0
 
     def reload(self, forced=False) -> bool:
         """
         Creates a new configuration based on current state and signals nginx to reload.
-        This is called whenever there's change in container or network state.
+        Event handlers should use `schedule_reload` instead, so that bursts of changes are merged.
         """
-        hosts: List[Host] = []
-        for host_data in self.config_data.host_list():
-            host = copy.deepcopy(host_data)
-
-            for i, location in enumerate(host.locations.values()):
-                location.container = list(location.containers)[0]
-
-                if len(location.containers) > 1:
-                    print("WARNING: Multiple containers for a single location", file=sys.stderr)
-                    # todo: this means that there are multiple containers for a single location
-                    # definitely should be using some load balancing here
-
-            hosts.append(host)
+        with self.lock:
+            hosts: List[Host] = list(self.config_data.host_list())
 
-        self.ssl_processor.process_ssl_certificates(hosts)
+        ssl_files = self.ssl_processor.process_ssl_certificates(hosts)
 
-        output = self.template.render(virtual_servers=hosts, config=self.config)
+        with self.lock:
+            views: List[HostView] = []
+            for host in hosts:
+                if host.is_empty():
+                    # removed while the certificates were being processed
+                    continue
+                views.append(HostView(host, ssl_files.get(host.hostname), self.config))
+            output = self.renderer.render(views)
+        print("Rendered %d of %d server blocks" % (self.renderer.rendered_count, len(views)))
         response = self.nginx.update_config(output)
         return response
 
-    def connect(self, network, container):
+    def schedule_reload(self):
+        """
+        Request a reload for a change in container or network state.
+        Requests are collected by the reload scheduler and applied together once the burst of events settles.
+        """
+        self.reload_scheduler.schedule()
+
+    def has_proxy_label(self, container: DockerContainer) -> bool:
+        label = self.config['proxy_label']
+        if label is None:
+            return True
+        labels = container.attrs["Config"].get("Labels") or {}
+        key, _, value = label.partition("=")
+        return key in labels and (not value or labels[key] == value)
+
+    def connect(self, network, container, inspected: Union[DockerContainer, None] = None,
+                network_name: Union[str, None] = None):
         if self.id is not None and container == self.id:
             if network not in self.networks:
-                self.networks[network] = self.client.networks.get(network).name
+                self.networks[network] = network_name if network_name else self.client.networks.get(network).name
                 self.rescan_and_reload()
         elif network in self.networks:
-            self.update_container(container)
+            self.update_container(container, inspected)
 
     def disconnect(self, network, container):
         if self.id is not None and container == self.id:
@@ -146,9 +253,18 @@ class WebServer:
         elif container in self.config_data.containers and network in self.networks:
             if not self.update_container(container):
                 self.remove_container(container)
-                self.reload()
 
-    def update_container(self, container_id) -> bool:
+    def inspect_container(self, container_id) -> Union[DockerContainer, None]:
+        """
+        Fetch the details of the container from docker. This is safe to call from multiple threads.
+        :return: the container or None if it no longer exists
+        """
+        try:
+            return self.client.containers.get(container_id)
+        except requests.exceptions.HTTPError:
+            return None
+
+    def update_container(self, container_id, container: Union[DockerContainer, None] = None) -> bool:
         """
         Rescan the container to detect changes. And update nginx configuration if necessary.
         This is usually called in one of the following conditions:
@@ -156,15 +272,15 @@ class WebServer:
         -- an existing container has left a network in which nginx-proxy is connected.
         -- during full container rescan
         :param container_id: container id to update
+        :param container: details of the container if already inspected
         :return: true if container state change affected the nginx configuration else false
         """
-        try:
-            if not self.config_data.has_container(container_id):
-                if self._register_container(self.client.containers.get(container_id)):
-                    self.reload()
-                    return True
-        except requests.exceptions.HTTPError as e:
-            pass
+        if not self.config_data.has_container(container_id):
+            if container is None:
+                container = self.inspect_container(container_id)
+            if container is not None and self._register_container(container):
+                self.schedule_reload()
+                return True
         return False
 
     def remove_container(self, container_id: str):
@@ -172,25 +288,79 @@ class WebServer:
         Removes container from the maintained list.
         This is called when a container dies or leaves a known network.
         """
-        deleted, deleted_domain = self.config_data.remove_container(container_id)
-        if deleted:
-            self.reload()
+        with self.lock:
+            self.inspected.pop(container_id, None)
+            dirty = self.config_data.remove_container(container_id)
+        if len(dirty):
+            self.schedule_reload()
 
     def rescan_all_container(self):
         """
         Rescan all the containers to detect changes, update nginx config if necessary.
         This is called in one of the following conditions:
         -- in the beginning of execution of the program
+        -- when this container joins or leaves a network
+        Only the containers in the known networks are candidates. They are listed without inspecting them,
+        and then the candidates are inspected concurrently.
         """
-        containers = self.client.containers.list()
-        self.config_data.containers = set()
-        self.config_data.config_map = {}
-        for container in containers:
-            self._register_container(container)
+        candidates = [x.id for x in self._list_candidates()]
+        with ThreadPoolExecutor(max_workers=self.config['scan_workers'], thread_name_prefix="docker-scan") as executor:
+            containers = [x for x in executor.map(self.inspect_container, candidates) if x is not None]
+        with self.lock:
+            self.config_data.clear()
+            self.inspected.clear()
+            for container in containers:
+                self._register_container(container)
+
+    def _list_candidates(self) -> List[DockerContainer]:
+        """
+        List the running containers in the known networks, without inspecting them.
+        """
+        if not len(self.networks):
+            return []
+        filters = {'network': list(self.networks.keys())}
+        if self.config['proxy_label'] is not None:
+            filters['label'] = self.config['proxy_label']
+        return [x for x in self.client.containers.list(sparse=True, filters=filters) if x.id != self.id]
+
+    @staticmethod
+    def _network_state(attrs: dict) -> FrozenSet[Tuple[str, str]]:
+        networks = (attrs.get("NetworkSettings") or {}).get("Networks") or {}
+        return frozenset((x.get("NetworkID"), x.get("IPAddress")) for x in networks.values())
+
+    def reconcile(self):
+        """
+        Fix the differences between the running containers and the containers known to the proxy,
+        e.g. changes missed while the event stream was disconnected.
+        Only the containers that are new or whose networks have changed since they were inspected are inspected.
+        Must be run on the event pipeline thread, so that it doesn't interleave with the events.
+        """
+        listed = {x.id: self._network_state(x.attrs) for x in self._list_candidates()}
+        with self.lock:
+            gone = [x for x in set(self.inspected.keys()).union(self.config_data.containers) if x not in listed]
+            changed = [x for x, state in listed.items() if self.inspected.get(x) != state]
+        for container_id in gone:
+            self.remove_container(container_id)
+        for container_id in changed:
+            self.remove_container(container_id)
+            container = self.inspect_container(container_id)
+            if container is None:
+                continue
+            if self._register_container(container):
+                self.schedule_reload()
+        if len(gone) or len(changed):
+            print("[Reconcile] Removed %d and re-inspected %d containers" % (len(gone), len(changed)))
+
+    def _reconcile_periodically(self):
+        while not self.shutdown_requested.wait(self.config['reconcile_interval']):
+            self.event_pipeline.submit_task(self.reconcile)
 
     def rescan_and_reload(self):
         self.rescan_all_container()
-        self.reload()
+        self.schedule_reload()
 
     def cleanup(self):
+        self.shutdown_requested.set()
+        self.event_pipeline.shutdown()
+        self.reload_scheduler.shutdown()
         self.ssl_processor.shutdown()